@@ -17,17 +17,20 @@ import random
 import re
 import sys
 import time
-import urllib
 import uuid
 
 from lxml import etree
 
+import acs4profile
+
 try:  # Python 3
     import http.client as httplib
     from io import StringIO
+    from urllib.parse import urlencode, unquote
 except ImportError:  # Python 2
     from StringIO import StringIO
     import httplib
+    from urllib import urlencode, unquote
 
 try:
     basestring
@@ -48,6 +51,14 @@ debug = False
 # Don't communicate with the server
 dry_run = False
 
+# An acs4cassette.cassette to record server exchanges to, or replay
+# them from instead of the server
+cassette = None
+
+# An acs4profile.profiler that profiles a sample of post() calls;
+# ACS4_PROFILE_DIR etc. in the environment set one up
+profiler = acs4profile.from_env('ACS4_PROFILE')
+
 # Show information about request serialization, for debugging
 # hmac issues
 show_serialization = False
@@ -108,8 +119,8 @@ def mint(server, secret, resource, action, ordersource, rights=None, orderid=Non
         }
     if rights is not None:
         argsobj['rights'] = rights
-    urlargs = urllib.urlencode(argsobj)
-    mac = hmac.new(base64.b64decode(secret), urlargs, hashlib.sha1)
+    urlargs = urlencode(argsobj)
+    mac = hmac.new(base64.b64decode(secret), urlargs.encode('utf-8'), hashlib.sha1)
     auth = mac.hexdigest()
     portstr = '' if port == 80 else ':{}'.format(port)
 
@@ -245,7 +256,7 @@ def upload(server, filehandle, password,
     el = etree.Element('package', nsmap={None: AdeptNS})
 
     if filehandle is not None:
-        etree.SubElement(el, 'data').text = base64.encodestring(filehandle.read())
+        etree.SubElement(el, 'data').text = base64.b64encode(filehandle.read()).decode('ascii')
     else:
         etree.SubElement(el, 'dataPath').text = datapath
 
@@ -296,6 +307,13 @@ def post(xml, server, port, password, api_path):
     one is found.
 
     """
+    if profiler is not None and profiler.sample():
+        return profiler.run('acs4' + api_path.replace('/', '_'),
+                            _post, xml, server, port, password, api_path)
+    return _post(xml, server, port, password, api_path)
+
+
+def _post(xml, server, port, password, api_path):
 
     # convert provided string to etree
     if isinstance(xml, basestring):
@@ -304,7 +322,7 @@ def post(xml, server, port, password, api_path):
     # Add 'envelope' and hmac
     post_expiration = make_expiration(expiration_secs) if expiration is None else expiration
     etree.SubElement(xml, 'expiration').text = post_expiration
-    post_nonce = base64.b64encode(os.urandom(20))[:20] if nonce is None else nonce
+    post_nonce = base64.b64encode(os.urandom(20))[:20].decode('ascii') if nonce is None else nonce
     etree.SubElement(xml, 'nonce').text = post_nonce
     etree.SubElement(xml, 'hmac').text = make_hmac(password, xml)
 
@@ -316,28 +334,38 @@ def post(xml, server, port, password, api_path):
     if dry_run:
         return None
 
-    headers = { 'Content-Type': 'application/vnd.adobe.adept+xml' }
-    conn = httplib.HTTPConnection(server, port)
-    conn.request('POST', api_path, request, headers)
+    if cassette is not None:
+        response_str = cassette.exchange(server, port, api_path, request, send)
+    else:
+        response_str = send(server, port, api_path, request)
 
     try:
-        response_str = conn.getresponse().read()
         response = etree.fromstring(response_str) # XXX could read directly?
     except etree.XMLSyntaxError:
-        raise Acs4Exception("Couldn't parse server response as XML: " + response_str)
-    conn.close()
+        raise Acs4Exception("Couldn't parse server response as XML: %r" % response_str)
 
     if debug:
         print(response_str)
 
     if response.tag == etree.QName(AdeptNS, 'error'):
-        raise Acs4Exception(urllib.unquote(response.get('data')))
+        raise Acs4Exception(unquote(response.get('data')))
     return response
 
 
+def send(server, port, api_path, request):
+    """ POST a serialized request to the server; returns the response body """
+    headers = { 'Content-Type': 'application/vnd.adobe.adept+xml' }
+    conn = httplib.HTTPConnection(server, port)
+    try:
+        conn.request('POST', api_path, request, headers)
+        return conn.getresponse().read()
+    finally:
+        conn.close()
+
+
 def get_distributor_info(server, password, distributor, port=defaultport):
     request_args = { 'distributor': distributor }
-    reply = request(server, 'Distributor', 'get', request_args, password)
+    reply = request(server, 'Distributor', 'get', request_args, password, port=port)
     return reply[0]
 
 
@@ -413,15 +441,17 @@ def make_hmac(password, el):
     if len(password) == 28 and password[-1] == '=':
         try:
             passhash = base64.b64decode(password)
-        except TypeError:
+        except (TypeError, ValueError):
             # if it's not a valid base64-encoded string, just move on.
             pass
     if passhash is None:
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
         passhasher = hashlib.sha1()
         passhasher.update(password)
         passhash = passhasher.digest()
 
-    mac = hmac.new(passhash, '', hashlib.sha1)
+    mac = hmac.new(passhash, b'', hashlib.sha1)
 
     if show_serialization:
         logger = debug_consumer()
@@ -430,7 +460,7 @@ def make_hmac(password, el):
 
     serialize_el(el, mac)
 
-    return base64.b64encode(mac.digest())
+    return base64.b64encode(mac.digest()).decode('ascii')
 
 
 def serialize_el(el, consumer):
@@ -439,15 +469,15 @@ def serialize_el(el, consumer):
     def consume_str(s, encoding='utf-8'):
         if isinstance(s, unicode):
             s = s.encode(encoding)
-        consumer.update(chr((len(s) >> 8) & 0xff))
-        consumer.update(chr((len(s) & 0xff)))
+        consumer.update(bytes(bytearray([(len(s) >> 8) & 0xff])))
+        consumer.update(bytes(bytearray([len(s) & 0xff])))
         consumer.update(s)
 
-    BEGIN_ELEMENT = '\x01'
-    END_ATTRIBUTES = '\x02'
-    END_ELEMENT = '\x03'
-    TEXT_NODE = '\x04'
-    ATTRIBUTE = '\x05'
+    BEGIN_ELEMENT = b'\x01'
+    END_ATTRIBUTES = b'\x02'
+    END_ELEMENT = b'\x03'
+    TEXT_NODE = b'\x04'
+    ATTRIBUTE = b'\x05'
 
     p = re.compile(r'(\{(.*)\})?(.*)')
     m = p.match(el.tag)
@@ -513,7 +543,7 @@ class debug_consumer:
             if ord(s) >= 1 and ord(s) <= 5:
                 self.s += ' ' + serialize_names[ord(s)]
         else:
-            self.s += s
+            self.s += s.decode('utf-8', 'replace')
         self.s += '\n'
     def dump(self):
         return self.s
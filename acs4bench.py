@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+End-to-end load generator for the lending stack: a weighted mix of
+link minting, ACS4 requests and bss lookups, at a fixed request rate
+or a fixed concurrency, reported as JSON.
+
+python acs4bench.py --rps=200 --duration=60 \\
+    --mix=mint:60,bss:30,request_get:5,query:5 \\
+    --server=acs4.example.org --password=PW --distributor=UUID \\
+    --mint_url=http://127.0.0.1:8083 --bss=http://127.0.0.1:8081 \\
+    --resources=resources.txt
+
+Operations:
+
+mint            GET --mint_url/mint (acs4mint.py), or with --secret and
+                no --mint_url, acs4.mint() in process
+request_get     DistributionRights get for a resource
+request_update  DistributionRights get, then update with the record
+                unchanged (an update nulls any field it leaves out) -
+                still a write, so needs --allow_writes (or --replay)
+query           queryresourceitems, a page at a random offset
+bss             one of is_loaned_out, resource_info, availability and
+                resource_info_by_id at --bss
+
+--record=CASSETTE saves the ACS4 operations' exchanges with the server
+to an acs4cassette file, and --replay=CASSETTE answers them from it
+instead of a server; bss can be pointed at an sqlite-backed instance
+(see bssfake.py) the same way.  A cassette only answers requests it
+has seen, so record and replay with the same --seed, --mix and
+--resources file: the Nth request of a run always picks the same
+operation, resource and offset.  The replay should send no more
+requests than the recording did.
+
+--resources names a file of resource uuids, optionally followed by a
+tab and the identifier, one per line.  Without it they're read from
+--bss /resource_info/, or made up.
+
+With --rps, requests are started on schedule whether or not earlier
+ones have finished, and latency is measured from the scheduled start,
+so a stalled server shows up as latency rather than as fewer requests.
+With --concurrency, that many clients each send their next request as
+soon as the last one finishes.
+
+"""
+from __future__ import print_function
+
+import itertools
+import json
+import optparse
+import random
+import sys
+import threading
+import time
+import uuid
+
+import acs4
+import acs4cassette
+import acs4rights
+from acs4stats import percentile
+
+try:  # Python 3
+    import queue
+    from urllib.request import urlopen
+    from urllib.parse import urlencode, quote
+except ImportError:  # Python 2
+    import Queue as queue
+    from urllib2 import urlopen
+    from urllib import urlencode, quote
+
+operations = ('mint', 'request_get', 'request_update', 'query', 'bss')
+
+bss_paths = ('/is_loaned_out/%(resource)s', '/resource_info/%(resource)s',
+             '/availability/%(identifier)s', '/resource_info_by_id/%(identifier)s')
+
+default_mix = 'mint:60,bss:30,request_get:5,query:5'
+
+http_timeout = 30
+
+
+def parse_mix(mix):
+    """ 'mint:60,bss:40' -> [('mint', 60.0), ('bss', 40.0)] """
+    weights = []
+    for part in mix.split(','):
+        name, _, weight = part.partition(':')
+        name = name.strip()
+        if name not in operations:
+            raise ValueError('unknown operation %s' % name)
+        weights.append((name, float(weight or 1)))
+    return weights
+
+
+class target(object):
+    """ The endpoints and test data each operation runs against """
+
+    def __init__(self, opts, resources):
+        self.opts = opts
+        self.resources = resources
+
+    def pick(self, rng):
+        resource, identifier = rng.choice(self.resources)
+        return resource, identifier
+
+    def http_get(self, url):
+        f = urlopen(url, timeout=http_timeout)
+        try:
+            f.read()
+        finally:
+            f.close()
+
+    def mint(self, rng):
+        resource, identifier = self.pick(rng)
+        if self.opts.mint_url:
+            self.http_get(self.opts.mint_url.rstrip('/') + '/mint?' + urlencode({'resource': resource}))
+        else:
+            acs4.mint(self.opts.server, self.opts.secret, resource, 'enterloan', 'acs4bench',
+                      port=self.opts.port)
+
+    def request_get(self, rng):
+        resource, identifier = self.pick(rng)
+        acs4.request(self.opts.server, 'DistributionRights', 'get',
+                     {'distributor': self.opts.distributor, 'resource': resource},
+                     self.opts.password, port=self.opts.port)
+
+    def request_update(self, rng):
+        """ Writes a resource's rights back as they are, in full """
+        resource, identifier = self.pick(rng)
+        current = acs4.request(self.opts.server, 'DistributionRights', 'get',
+                               {'distributor': self.opts.distributor, 'resource': resource},
+                               self.opts.password, port=self.opts.port)
+        if not current:
+            raise acs4.Acs4Exception('no distribution rights for %s' % resource)
+        acs4.request(self.opts.server, 'DistributionRights', 'update',
+                     acs4rights.request_args(current[0]), self.opts.password, port=self.opts.port)
+
+    def query(self, rng):
+        acs4.queryresourceitems(self.opts.server, self.opts.password,
+                                start=rng.randint(0, max(0, len(self.resources) - 10)), count=10,
+                                distributor=self.opts.distributor, port=self.opts.port)
+
+    def bss(self, rng):
+        resource, identifier = self.pick(rng)
+        path = rng.choice(bss_paths) % {'resource': quote(resource),
+                                           'identifier': quote(identifier)}
+        self.http_get(self.opts.bss.rstrip('/') + path)
+
+
+class recorder(object):
+    """ Latencies and errors per operation """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict((op, []) for op in operations)
+        self.errors = dict((op, 0) for op in operations)
+        self.error_samples = {}
+
+    def record(self, op, elapsed, error=None):
+        with self.lock:
+            if error is None:
+                self.latencies[op].append(elapsed)
+            else:
+                self.errors[op] += 1
+                self.error_samples.setdefault(op, '%s: %s' % (error.__class__.__name__, error))
+
+    def report(self, elapsed):
+        def summary(latencies, errors):
+            latencies = sorted(latencies)
+            total = len(latencies) + errors
+            return {
+                'requests': total,
+                'errors': errors,
+                'error_rate': float(errors) / total if total else 0.0,
+                'throughput': len(latencies) / elapsed if elapsed else 0.0,
+                'latency': dict(('p%d' % p, percentile(latencies, p)) for p in (50, 95, 99)),
+                'max': latencies[-1] if latencies else None,
+            }
+        with self.lock:
+            ops = dict((op, summary(self.latencies[op], self.errors[op]))
+                       for op in operations if self.latencies[op] or self.errors[op])
+            everything = summary([l for op in operations for l in self.latencies[op]],
+                                 sum(self.errors.values()))
+            samples = dict(self.error_samples)
+        everything['seconds'] = elapsed
+        everything['operations'] = ops
+        if samples:
+            everything['error_samples'] = samples
+        return everything
+
+
+def request_rng(seed, n):
+    """ The random choices for request n of a run: the same for the same seed """
+    return random.Random(seed * 1000003 + n)
+
+
+def run_one(tgt, rec, op, rng, scheduled=None):
+    start = time.time() if scheduled is None else scheduled
+    try:
+        getattr(tgt, op)(rng)
+    except Exception as e:
+        rec.record(op, time.time() - start, e)
+    else:
+        rec.record(op, time.time() - start)
+
+
+def chooser(mix):
+    names = [name for name, weight in mix]
+    weights = [weight for name, weight in mix]
+    total = sum(weights)
+
+    def choose(rng):
+        r = rng.random() * total
+        for name, weight in zip(names, weights):
+            r -= weight
+            if r < 0:
+                return name
+        return names[-1]
+    return choose
+
+
+def run_concurrency(tgt, rec, choose, concurrency, duration, seed):
+    deadline = time.time() + duration
+    counter = itertools.count()
+
+    def client():
+        while time.time() < deadline:
+            rng = request_rng(seed, next(counter))
+            run_one(tgt, rec, choose(rng), rng)
+
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return {}
+
+
+def run_rate(tgt, rec, choose, rps, duration, workers, seed):
+    q = queue.Queue()
+
+    def worker():
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            op, rng, scheduled = item
+            run_one(tgt, rec, op, rng, scheduled)
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    start = time.time()
+    sent = 0
+    max_backlog = 0
+    while True:
+        scheduled = start + sent / float(rps)
+        if scheduled - start >= duration:
+            break
+        delay = scheduled - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        rng = request_rng(seed, sent)
+        q.put((choose(rng), rng, scheduled))
+        sent += 1
+        max_backlog = max(max_backlog, q.qsize())
+    for t in threads:
+        q.put(None)
+    for t in threads:
+        t.join()
+    # a backlog means the workers, not the server, were the bottleneck
+    return {'target_rps': rps, 'max_backlog': max_backlog}
+
+
+def load_resources(opts):
+    """ [(resource uuid, identifier)] to exercise """
+    if opts.resources:
+        resources = []
+        with open(opts.resources) as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if parts[0]:
+                    resources.append((parts[0], parts[1] if len(parts) > 1 else parts[0]))
+        return resources
+    if opts.bss:
+        f = urlopen(opts.bss.rstrip('/') + '/resource_info/?limit=1000&format=compact'
+                    '&fields=resourceid,identifier', timeout=http_timeout)
+        page = json.loads(f.read().decode('utf-8'))
+        f.close()
+        if page['resources']:
+            return [(r['resourceid'], r['identifier'] or '') for r in page['resources']]
+    return [(uuid.uuid4().urn, 'bench%04d' % i) for i in range(1000)]
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Load test ACS4, acs4mint and bss with a mix of requests.')
+    parser.add_option('--mix',
+                      action='store',
+                      default=default_mix,
+                      help='op:weight,... from %s (default %s)' % (', '.join(operations), default_mix))
+    parser.add_option('--rps',
+                      action='store',
+                      type='float',
+                      help='Start this many requests per second')
+    parser.add_option('--concurrency',
+                      action='store',
+                      type='int',
+                      help='Or keep this many requests in flight')
+    parser.add_option('--workers',
+                      action='store',
+                      type='int',
+                      default=64,
+                      help='Threads sending requests with --rps (default 64)')
+    parser.add_option('--duration',
+                      action='store',
+                      type='float',
+                      default=30,
+                      help='Seconds to run (default 30)')
+    parser.add_option('--server',
+                      action='store',
+                      help='ACS4 server, for mint links and request / query operations')
+    parser.add_option('--port',
+                      action='store',
+                      type='int',
+                      default=acs4.defaultport,
+                      help='ACS4 server port (default 8080)')
+    parser.add_option('-p', '--password',
+                      action='store',
+                      help='ACS4 password')
+    parser.add_option('--distributor',
+                      action='store',
+                      metavar='UUID')
+    parser.add_option('--secret',
+                      action='store',
+                      help='Distributor sharedSecret, to mint in process')
+    parser.add_option('--mint_url',
+                      action='store',
+                      help='acs4mint.py service to mint through')
+    parser.add_option('--bss',
+                      action='store',
+                      metavar='URL',
+                      help='bss base url, e.g. http://127.0.0.1:8081')
+    parser.add_option('--resources',
+                      action='store',
+                      help='File of resource uuids [TAB identifier] to use')
+    parser.add_option('--record',
+                      action='store',
+                      metavar='CASSETTE',
+                      help='Record ACS4 exchanges to a cassette, for --replay')
+    parser.add_option('--replay',
+                      action='store',
+                      metavar='CASSETTE',
+                      help='Answer ACS4 operations from a recorded cassette')
+    parser.add_option('--latency_scale',
+                      action='store',
+                      type='float',
+                      default=1.0,
+                      help='With --replay, multiply recorded server times by this (default 1)')
+    parser.add_option('--seed',
+                      action='store',
+                      type='int',
+                      help='Make the same requests as another run with this seed (default random)')
+    parser.add_option('--allow_writes',
+                      action='store_true',
+                      help='Allow request_update against a real server')
+    opts, args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(opts.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    ops = set(name for name, weight in mix)
+    if (opts.rps is None) == (opts.concurrency is None):
+        parser.error('Please supply one of --rps and --concurrency')
+    if 'bss' in ops and not opts.bss:
+        parser.error('bss operations need --bss')
+    if 'mint' in ops and not (opts.mint_url or (opts.secret and opts.server)):
+        parser.error('mint operations need --mint_url, or --secret and --server')
+    if ops & set(['request_get', 'request_update', 'query']):
+        if not opts.server or not opts.password:
+            parser.error('request and query operations need --server and --password')
+        if not opts.distributor and ops & set(['request_get', 'request_update']):
+            parser.error('request operations need --distributor')
+    if opts.record and opts.replay:
+        parser.error('Please supply only one of --record and --replay')
+    if 'request_update' in ops and not (opts.allow_writes or opts.replay):
+        parser.error('request_update changes ACS4 data; add --allow_writes')
+    if opts.record:
+        acs4.cassette = acs4cassette.cassette(opts.record, 'record')
+    if opts.replay:
+        acs4.cassette = acs4cassette.cassette(opts.replay, 'replay', latency_scale=opts.latency_scale)
+
+    seed = opts.seed if opts.seed is not None else random.randint(0, 2 ** 31)
+
+    tgt = target(opts, load_resources(opts))
+    rec = recorder()
+    choose = chooser(mix)
+    start = time.time()
+    if opts.rps is not None:
+        extra = run_rate(tgt, rec, choose, opts.rps, opts.duration, opts.workers, seed)
+    else:
+        extra = run_concurrency(tgt, rec, choose, opts.concurrency, opts.duration, seed)
+    result = rec.report(time.time() - start)
+    result.update(extra)
+    result['seed'] = seed
+    json.dump(result, sys.stdout, indent=4, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
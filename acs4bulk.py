@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Bulk upload: package a directory tree (or a manifest of paths) into
+ACS4 with several uploads in flight, optionally distributing each new
+resource as it's uploaded.
+
+python acs4bulk.py SERVER /data/books --password=PW --journal=books.journal
+python acs4bulk.py SERVER --manifest=paths.txt --datapath --password=PW --journal=books.journal \\
+    --distributor=UUID --distributionType=loan --available=1 --returnable=true \\
+    --permissions=sample_permissions.xml
+
+Each finished step is appended to the journal as a line of JSON, so a
+rerun with the same journal skips files already uploaded (and
+distributed).  The journal is also the record of which resource ID
+each file became.
+
+upload() peaks at about 6 times the file size in memory: the file,
+its base64 text, lxml's copy of that, the copies made to sign the
+request and the serialized request itself.  --max_memory bounds that
+estimate over all uploads in flight.  With --datapath the paths are on the ACS4 server and ACS4
+reads them itself, so only the concurrency limit applies.
+
+"""
+from __future__ import print_function
+
+import json
+import optparse
+import os
+import sys
+import threading
+import time
+
+import acs4
+
+try:  # Python 3
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+default_extensions = 'epub,pdf'
+
+# upload() peak memory use per byte of file, measured with ru_maxrss
+# over 10MB and 50MB uploads (5.9x)
+memory_factor = 6
+
+
+class budget(object):
+    """ A pool of bytes that uploads reserve before reading their file """
+
+    def __init__(self, total):
+        self.total = total
+        self.free = total
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        # something bigger than the whole budget waits until it can run alone
+        n = min(n, self.total)
+        with self.cond:
+            while self.free < n:
+                self.cond.wait()
+            self.free -= n
+        return n
+
+    def release(self, n):
+        with self.cond:
+            self.free += n
+            self.cond.notify_all()
+
+
+class journal(object):
+    """ Append-only JSON lines: {"path", "step", ...}, step being 'uploaded' or 'distributed' """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a partial last line from an interrupted run
+                        continue
+                    self.done.setdefault(entry['path'], {}).update(entry)
+        self.f = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def record(self, path, step, **kw):
+        entry = dict(kw, path=path, step=step, time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+        line = json.dumps(entry, sort_keys=True)
+        with self.lock:
+            self.done.setdefault(path, {}).update(entry)
+            self.f.write(line + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+def walk(root, extensions):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower().lstrip('.') in extensions:
+                yield os.path.join(dirpath, name)
+
+
+def read_manifest(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+class uploader(object):
+
+    def __init__(self, server, password, jnl, port=acs4.defaultport,
+                 use_datapath=False, permissions=None, rights=None, memory=None):
+        self.server = server
+        self.password = password
+        self.journal = jnl
+        self.port = port
+        self.use_datapath = use_datapath
+        self.permissions = permissions
+        self.rights = rights
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.counts = {'uploaded': 0, 'distributed': 0, 'skipped': 0, 'failed': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def upload(self, path):
+        if self.use_datapath:
+            return acs4.upload(self.server, None, self.password, datapath=path,
+                               permissions=self.permissions, port=self.port)
+        reserved = 0
+        if self.memory is not None:
+            reserved = self.memory.acquire(int(os.path.getsize(path) * memory_factor))
+        try:
+            with open(path, 'rb') as fh:
+                return acs4.upload(self.server, fh, self.password,
+                                   permissions=self.permissions, port=self.port)
+        finally:
+            if reserved:
+                self.memory.release(reserved)
+
+    def distribute(self, resource):
+        request_args = dict(self.rights, resource=resource)
+        acs4.request(self.server, 'DistributionRights', 'create', request_args, self.password,
+                     permissions=self.permissions, port=self.port)
+
+    def process(self, path):
+        done = self.journal.done.get(path, {})
+        resource = done.get('resource')
+        if resource and (self.rights is None or done.get('step') == 'distributed'):
+            self.count('skipped')
+            return
+        try:
+            if not resource:
+                result = self.upload(path)
+                if acs4.dry_run:
+                    return
+                resource = result.get('resource') if isinstance(result, dict) else None
+                if not resource:
+                    raise acs4.Acs4Exception('no resource id in upload reply')
+                self.journal.record(path, 'uploaded', resource=resource)
+                self.count('uploaded')
+            if self.rights is not None:
+                self.distribute(resource)
+                self.journal.record(path, 'distributed', resource=resource)
+                self.count('distributed')
+        except Exception as e:
+            self.count('failed')
+            print('%s: %s' % (path, e), file=sys.stderr)
+
+    def run(self, paths, workers):
+        # a short queue keeps a huge manifest from being read all at once
+        q = queue.Queue(workers * 2)
+
+        def work():
+            while True:
+                path = q.get()
+                if path is None:
+                    return
+                self.process(path)
+
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for path in paths:
+            q.put(path)
+        for t in threads:
+            q.put(None)
+        for t in threads:
+            t.join()
+        return self.counts
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options] SERVER [DIRECTORY]',
+                                   description='Upload many files to ACS4, resumably.')
+    parser.add_option('-p', '--password',
+                      action='store',
+                      help='ACS4 password')
+    parser.add_option('--port',
+                      action='store',
+                      type='int',
+                      default=acs4.defaultport,
+                      help='Server port to use (default 8080)')
+    parser.add_option('--manifest',
+                      action='store',
+                      help='File listing one path per line, instead of DIRECTORY')
+    parser.add_option('--datapath',
+                      action='store_true',
+                      help='Paths are on the ACS4 server; upload by dataPath')
+    parser.add_option('--extensions',
+                      action='store',
+                      default=default_extensions,
+                      help='File extensions to pick up from DIRECTORY (default %s)' % default_extensions)
+    parser.add_option('--journal',
+                      action='store',
+                      help='Journal file recording finished files (required)')
+    parser.add_option('-j', '--workers',
+                      action='store',
+                      type='int',
+                      default=4,
+                      help='Uploads in flight (default 4)')
+    parser.add_option('--max_memory',
+                      action='store',
+                      type='int',
+                      default=512,
+                      help='MB of file data held by all uploads in flight (default 512)')
+    parser.add_option('--permissions',
+                      action='store',
+                      help='xml file of ACS4 perms')
+    parser.add_option('-d', '--debug',
+                      action='store_true',
+                      help='Print debugging output')
+    parser.add_option('--dry_run',
+                      action='store_true',
+                      help='Don\'t post to server')
+
+    group = optparse.OptionGroup(parser, 'Distribution arguments',
+                                 'With --distributor, each uploaded resource gets'
+                                 ' DistributionRights created')
+    group.add_option('--distributor',
+                     action='store',
+                     metavar='UUID')
+    group.add_option('--distributionType',
+                     action='store',
+                     default='loan')
+    group.add_option('--available',
+                     action='store',
+                     default='1')
+    group.add_option('--returnable',
+                     action='store',
+                     default='true')
+    group.add_option('--notifyURL',
+                     action='store',
+                     metavar='URL')
+    parser.add_option_group(group)
+
+    opts, args = parser.parse_args(argv)
+
+    if not opts.password:
+        parser.error('We think a password arg might be required')
+    if not opts.journal:
+        parser.error('Please supply --journal')
+    if len(args) == 2 and not opts.manifest:
+        paths = walk(args[1], set(opts.extensions.lower().split(',')))
+    elif len(args) == 1 and opts.manifest:
+        paths = read_manifest(opts.manifest)
+    else:
+        parser.error('Please supply SERVER and either DIRECTORY or --manifest')
+    if opts.datapath and not opts.manifest:
+        parser.error('--datapath needs a --manifest of server paths')
+    if opts.debug:
+        acs4.debug = True
+    if opts.dry_run:
+        acs4.dry_run = True
+
+    permissions = open(opts.permissions).read() if opts.permissions else None
+    rights = None
+    if opts.distributor:
+        rights = {
+            'distributor': opts.distributor,
+            'distributionType': opts.distributionType,
+            'available': opts.available,
+            'returnable': opts.returnable,
+            'notifyURL': opts.notifyURL,
+            }
+
+    jnl = journal(opts.journal)
+    up = uploader(args[0], opts.password, jnl, port=opts.port,
+                  use_datapath=opts.datapath, permissions=permissions, rights=rights,
+                  memory=budget(opts.max_memory * 1024 * 1024))
+    start = time.time()
+    counts = up.run(paths, max(1, opts.workers))
+    jnl.close()
+    counts['seconds'] = round(time.time() - start, 1)
+    json.dump(counts, sys.stdout, indent=4, sort_keys=True)
+    print()
+    if counts['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Record and replay the request / response exchanges acs4.post() has
+with the ACS4 server, so a real workload can be rerun without the
+server, e.g. to benchmark client-side changes.
+
+import acs4, acs4cassette
+acs4.cassette = acs4cassette.cassette('prod.cassette', 'record')
+... run the workload against the real server ...
+
+acs4.cassette = acs4cassette.cassette('prod.cassette', 'replay', latency_scale=1.0)
+... run it again; responses come from the cassette, after the
+    recorded server time (times latency_scale; 0 for no delay) ...
+
+or from the command line: acs4cmd.py --record=FILE / --replay=FILE.
+
+A cassette is a gzipped file of JSON lines, one per exchange: the api
+path, the request xml, the response body and the server time.  The
+nonce, expiration and hmac vary per request, so they're blanked
+before requests are matched.  Identical requests are replayed in the
+order they were recorded, starting over when a cassette runs out.
+
+"""
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+
+import acs4
+
+_varying = re.compile(br'<(nonce|expiration|hmac)>[^<]*</\1>')
+
+
+def normalize(request):
+    """ The request xml with its per-request nonce, expiration and hmac blanked """
+    if not isinstance(request, bytes):
+        request = request.encode('utf-8')
+    return _varying.sub(br'<\1/>', request)
+
+
+def request_key(api_path, request):
+    return hashlib.sha1(api_path.encode('utf-8') + b'\n' + normalize(request)).hexdigest()
+
+
+class cassette(object):
+
+    def __init__(self, path, mode, latency_scale=1.0):
+        if mode not in ('record', 'replay'):
+            raise acs4.Acs4Exception("cassette mode should be 'record' or 'replay'")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.recorded = {}
+        self.played = {}
+        if mode == 'replay':
+            self.load()
+
+    def load(self):
+        with gzip.open(self.path, 'rb') as f:
+            for line in f:
+                entry = json.loads(line.decode('utf-8'))
+                self.recorded.setdefault(entry['key'], []).append(entry)
+
+    def exchange(self, server, port, api_path, request, send):
+        """ Called by acs4.post() in place of send() """
+        key = request_key(api_path, request)
+        if self.mode == 'replay':
+            return self.replay(key, api_path)
+        start = time.time()
+        response = send(server, port, api_path, request)
+        self.record(key, api_path, request, response, time.time() - start)
+        return response
+
+    def record(self, key, api_path, request, response, elapsed):
+        entry = {
+            'key': key,
+            'path': api_path,
+            'request': normalize(request).decode('utf-8'),
+            'response': response.decode('utf-8') if isinstance(response, bytes) else response,
+            'elapsed': round(elapsed, 6),
+            'time': round(time.time(), 3),
+        }
+        line = (json.dumps(entry, sort_keys=True) + '\n').encode('utf-8')
+        with self.lock:
+            # each append is its own gzip member; gzip reads them back as one stream
+            with gzip.open(self.path, 'ab') as f:
+                f.write(line)
+
+    def replay(self, key, api_path):
+        entries = self.recorded.get(key)
+        if not entries:
+            raise acs4.Acs4Exception('no recorded exchange for this %s request' % api_path)
+        with self.lock:
+            i = self.played.get(key, 0)
+            self.played[key] = i + 1
+        entry = entries[i % len(entries)]
+        if self.latency_scale:
+            time.sleep(entry['elapsed'] * self.latency_scale)
+        return entry['response'].encode('utf-8')
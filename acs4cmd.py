@@ -10,6 +10,8 @@ from __future__ import print_function
 import sys
 import optparse
 import acs4
+import acs4cassette
+import acs4profile
 import json
 
 def main(argv):
@@ -61,6 +63,23 @@ python acs4cmd.py server request api request_type
                       action='store',
                       default=acs4.defaultport,
                       help='Server port to use (default 8080)')
+    parser.add_option('--record',
+                      action='store',
+                      metavar='FILE',
+                      help='Record server exchanges to a cassette file')
+    parser.add_option('--replay',
+                      action='store',
+                      metavar='FILE',
+                      help='Answer from a recorded cassette instead of the server')
+    parser.add_option('--profile',
+                      action='store',
+                      metavar='DIR',
+                      help='Write a cProfile profile of each server request to DIR')
+    parser.add_option('--latency_scale',
+                      action='store',
+                      type='float',
+                      default=1.0,
+                      help='With --replay, multiply recorded server times by this (default 1)')
 
 
     group = optparse.OptionGroup(parser, "Request arguments",
@@ -127,6 +146,15 @@ python acs4cmd.py server request api request_type
         acs4.debug = True
     if opts.dry_run:
         acs4.dry_run = True
+    if opts.profile:
+        acs4.profiler = acs4profile.profiler(opts.profile)
+    if opts.record and opts.replay:
+        parser.error('Please supply only one of --record and --replay')
+    if opts.record:
+        acs4.cassette = acs4cassette.cassette(opts.record, 'record')
+    if opts.replay:
+        acs4.cassette = acs4cassette.cassette(opts.replay, 'replay',
+                                              latency_scale=opts.latency_scale)
 
     if not opts.password:
         parser.error('We think a password arg might be required')
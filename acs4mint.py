@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+A small long-running HTTP service that mints ACS4 download links.
+
+Distributor secrets are fetched once at startup with
+get_distributor_info and refreshed in the background, so minting a
+link is an in-memory hmac and never waits on the ACS4 server.
+
+python acs4mint.py SERVER --password=PW --distributor=UUID [--distributor=UUID ...]
+
+GET  /mint?resource=UUID[&distributor=UUID][&action=enterloan][&orderid=ID][&rights=R]
+        -> {"url": "http://SERVER:8080/fulfillment/URLLink.acsm?..."}
+POST /mint    a JSON list of objects with the same keys
+        -> a list of {"url": ...} or {"error": ...}, in order
+GET  /stats   counts and latency percentiles (seconds)
+
+Orderids must be unique within the link expiration window, or
+fulfillment fails; a repeated orderid is refused with a 409 (or an
+error entry in a batch).  Omit orderid to have one generated.
+
+"""
+from __future__ import print_function
+
+import collections
+import json
+import optparse
+import sys
+import threading
+import time
+import uuid
+
+import acs4
+from acs4stats import percentile
+
+try:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+# latencies kept for the /stats percentiles
+latency_samples = 10000
+
+# largest batch accepted by POST /mint
+max_batch = 10000
+
+# log each request to stderr
+debug = False
+
+
+class MintError(Exception):
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class distributors(object):
+    """ distributor uuid -> (sharedSecret, name), kept fresh by a background thread """
+
+    def __init__(self, server, password, ids, port=acs4.defaultport):
+        self.server = server
+        self.password = password
+        self.ids = list(ids)
+        self.port = port
+        self.info = {}
+        self.refreshed = None
+        self.refresh_errors = 0
+
+    def refresh(self):
+        """ Re-fetch every distributor; on failure the old secret stays in use """
+        info = dict(self.info)
+        ok = True
+        for distributor in self.ids:
+            try:
+                d = acs4.get_distributor_info(self.server, self.password, distributor, port=self.port)
+                info[distributor] = (d['sharedSecret'], d['name'])
+            except Exception as e:
+                ok = False
+                self.refresh_errors += 1
+                print('refreshing %s: %s' % (distributor, e), file=sys.stderr)
+        # swap the whole dict so readers never see a partial update
+        self.info = info
+        if ok:
+            self.refreshed = time.time()
+
+    def start(self, interval):
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        t = threading.Thread(target=loop, name='distributor-refresh')
+        t.daemon = True
+        t.start()
+
+    def get(self, distributor):
+        try:
+            return self.info[distributor]
+        except KeyError:
+            raise MintError('unknown distributor %s' % distributor, 404)
+
+
+class orderids(object):
+    """ Orderids handed out within the last 'window' seconds """
+
+    def __init__(self, window):
+        self.window = window
+        self.seen = set()
+        self.expiry = collections.deque()
+        self.lock = threading.Lock()
+
+    def claim(self, orderid, now=None):
+        """ Returns False if orderid was already used within the window """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                self.seen.discard(self.expiry.popleft()[1])
+            if orderid in self.seen:
+                return False
+            self.seen.add(orderid)
+            self.expiry.append((now + self.window, orderid))
+            return True
+
+    def __len__(self):
+        return len(self.seen)
+
+
+class minter(object):
+
+    def __init__(self, dists, window, server, port=acs4.defaultport, default_distributor=None):
+        self.dists = dists
+        self.orderids = orderids(window)
+        self.server = server
+        self.port = port
+        self.default_distributor = default_distributor
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=latency_samples)
+        self.counts = collections.Counter()
+        self.started = time.time()
+
+    def mint(self, args):
+        """ Mint one link from a dict of request args; returns the url """
+        start = time.time()
+        try:
+            resource = args.get('resource')
+            if not resource:
+                raise MintError('resource is required')
+            distributor = args.get('distributor') or self.default_distributor
+            if not distributor:
+                raise MintError('distributor is required')
+            secret, name = self.dists.get(distributor)
+            orderid = args.get('orderid')
+            if orderid is None:
+                orderid = uuid.uuid4().urn
+            elif not self.orderids.claim(orderid, start):
+                with self.lock:
+                    self.counts['duplicates'] += 1
+                raise MintError('orderid %s already used' % orderid, 409)
+            try:
+                url = acs4.mint(self.server, secret, resource,
+                                args.get('action') or 'enterloan', name,
+                                rights=args.get('rights'), orderid=orderid, port=self.port)
+            except acs4.Acs4Exception as e:
+                raise MintError(str(e))
+        except MintError:
+            with self.lock:
+                self.counts['errors'] += 1
+            raise
+        elapsed = time.time() - start
+        with self.lock:
+            self.counts['minted'] += 1
+            self.latencies.append(elapsed)
+        return url
+
+    def mint_batch(self, items):
+        if not isinstance(items, list):
+            raise MintError('expected a JSON list')
+        if len(items) > max_batch:
+            raise MintError('at most %d links per batch' % max_batch, 413)
+        with self.lock:
+            self.counts['batches'] += 1
+        results = []
+        for args in items:
+            try:
+                if not isinstance(args, dict):
+                    raise MintError('expected a JSON object')
+                results.append({'url': self.mint(args)})
+            except MintError as e:
+                results.append({'error': str(e), 'status': e.status})
+        return results
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+        return {
+            'minted': counts.get('minted', 0),
+            'errors': counts.get('errors', 0),
+            'duplicates': counts.get('duplicates', 0),
+            'batches': counts.get('batches', 0),
+            'uptime': time.time() - self.started,
+            'orderids_tracked': len(self.orderids),
+            'distributors': sorted(self.dists.info),
+            'secrets_refreshed': self.dists.refreshed,
+            'refresh_errors': self.dists.refresh_errors,
+            'latency': dict(('p%d' % p, percentile(latencies, p)) for p in (50, 95, 99)),
+            'latency_samples': len(latencies),
+        }
+
+
+class handler(BaseHTTPRequestHandler):
+    minter = None
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            return self.send_json(200, self.minter.stats())
+        if url.path != '/mint':
+            return self.send_json(404, {'error': 'not found'})
+        args = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        try:
+            self.send_json(200, {'url': self.minter.mint(args)})
+        except MintError as e:
+            self.send_json(e.status, {'error': str(e)})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/mint':
+            return self.send_json(404, {'error': 'not found'})
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            items = json.loads(self.rfile.read(length).decode('utf-8'))
+            self.send_json(200, self.minter.mint_batch(items))
+        except ValueError:
+            self.send_json(400, {'error': 'request body is not JSON'})
+        except MintError as e:
+            self.send_json(e.status, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        if debug:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class threaded_server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options] SERVER',
+                                   description='Serve ACS4 download links minted in memory.')
+    parser.add_option('-p', '--password',
+                      action='store',
+                      help='ACS4 password')
+    parser.add_option('--distributor',
+                      action='append',
+                      metavar='UUID',
+                      help='Distributor to load secrets for; repeat for more.'
+                      ' The first is the default for requests that omit it.')
+    parser.add_option('--port',
+                      action='store',
+                      type='int',
+                      default=acs4.defaultport,
+                      help='ACS4 server port, also used in minted links (default 8080)')
+    parser.add_option('--listen',
+                      action='store',
+                      default='127.0.0.1:8083',
+                      help='host:port to serve on (default 127.0.0.1:8083)')
+    parser.add_option('--refresh',
+                      action='store',
+                      type='float',
+                      default=300,
+                      help='Seconds between distributor secret refreshes (default 300)')
+    parser.add_option('--window',
+                      action='store',
+                      type='int',
+                      default=acs4.expiration_secs,
+                      help='Seconds an orderid stays reserved (default %d)' % acs4.expiration_secs)
+    parser.add_option('-d', '--debug',
+                      action='store_true',
+                      help='Log requests')
+    opts, args = parser.parse_args(argv)
+
+    if len(args) != 1:
+        parser.error('Please supply the ACS4 server')
+    if not opts.password:
+        parser.error('We think a password arg might be required')
+    if not opts.distributor:
+        parser.error('Please supply at least one --distributor')
+    if opts.debug:
+        global debug
+        debug = True
+
+    server = args[0]
+    dists = distributors(server, opts.password, opts.distributor, port=opts.port)
+    dists.refresh()
+    if not dists.info:
+        sys.exit('Could not load any distributor secrets')
+    dists.start(opts.refresh)
+
+    handler.minter = minter(dists, opts.window, server, port=opts.port,
+                            default_distributor=opts.distributor[0])
+    host, _, port = opts.listen.rpartition(':')
+    httpd = threaded_server((host or '', int(port)), handler)
+    print('minting on %s' % opts.listen)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
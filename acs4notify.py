@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Receiver for the fulfillment notifications ACS4 posts to a
+distribution's notifyURL.
+
+python acs4notify.py /var/lib/acs4notify.db --listen=0.0.0.0:8082 [--secret=SHARED_SECRET]
+
+then set notifyURL on the distribution rights, e.g.
+
+python acs4cmd.py $SERVER request DistributionRights update ... --notifyURL=http://thishost:8082/notify
+
+Posts are parsed with acs4.read_xml / el_to_o and queued; a single
+writer thread commits them to a local sqlite file in batches, and each
+post is answered once its batch is committed, so ACS4 only sees a 200
+for notifications that are stored.  ACS4 retries notifications, so
+they're kept once per (transaction, event), event being 'fulfilled' or
+'returned'; repeats are acknowledged and dropped.
+
+Stored notifications are published as a feed, so loan state can be
+followed without polling the ACS4 MySQL database:
+
+GET /events?after=ID[&limit=N][&wait=SECS]
+        -> {"events": [...], "last": ID}, waiting up to SECS for new ones
+GET /stats
+
+With --secret (the distributor's base64 sharedSecret), posts whose
+hmac doesn't match are refused.
+
+"""
+from __future__ import print_function
+
+import datetime
+import hmac
+import json
+import optparse
+import sqlite3
+import sys
+import threading
+import time
+
+import acs4
+
+try:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    import queue
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    import Queue as queue
+
+# most notifications committed in one transaction
+batch_size = 500
+
+# how long the writer waits to fill a batch
+batch_wait = 0.05
+
+# posts waiting for the writer; further posts get a 503 and ACS4 retries
+queue_size = 20000
+
+# how long a post waits for its batch to commit before giving up
+commit_timeout = 30
+
+max_events_page = 1000
+max_events_wait = 30
+
+# log each request to stderr
+debug = False
+
+create_sql = [
+    """
+    CREATE TABLE IF NOT EXISTS notification (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        transid TEXT NOT NULL,
+        event TEXT NOT NULL,
+        distributor TEXT,
+        resource TEXT,
+        fulfillment TEXT,
+        user TEXT,
+        device TEXT,
+        received TEXT NOT NULL,
+        body TEXT NOT NULL,
+        UNIQUE (transid, event)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS notification_resource ON notification (resource)",
+]
+
+insert_sql = """
+    INSERT OR IGNORE INTO notification
+        (transid, event, distributor, resource, fulfillment, user, device, received, body)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+event_columns = ('id', 'transid', 'event', 'distributor', 'resource', 'fulfillment',
+                 'user', 'device', 'received', 'body')
+
+
+class NotifyError(Exception):
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    # readers of the feed don't block the writer
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def create_tables(conn):
+    for sql in create_sql:
+        conn.execute(sql)
+    conn.commit()
+
+
+def _text(v):
+    if v is None or isinstance(v, acs4.basestring):
+        return v
+    return json.dumps(v, sort_keys=True)
+
+
+def parse(body, secret=None):
+    """ Parse a notification post into a notification table row (less id) """
+    try:
+        el = acs4.read_xml(body, 'notification')
+    except acs4.etree.XMLSyntaxError as e:
+        raise NotifyError('not XML: %s' % e)
+    except acs4.Acs4Exception:
+        raise NotifyError('no notification element')
+    if secret is not None:
+        hmac_el = el.find(acs4.AdeptNSBracketed + 'hmac')
+        if hmac_el is None:
+            raise NotifyError('unsigned notification', 403)
+        el.remove(hmac_el)
+        try:
+            expected = acs4.make_hmac(secret, el).encode('ascii')
+            given = (hmac_el.text or '').strip().encode('ascii')
+        except (TypeError, ValueError):
+            # a non-ascii hmac, or a secret make_hmac can't use
+            raise NotifyError('bad hmac', 403)
+        if not hmac.compare_digest(expected, given):
+            raise NotifyError('bad hmac', 403)
+    o = acs4.el_to_o(el)
+    if not isinstance(o, dict) or not o.get('transaction'):
+        raise NotifyError('notification has no transaction')
+    event = 'returned' if o.get('returned') == 'true' else 'fulfilled'
+    received = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    return (o['transaction'], event,
+            _text(o.get('distributor')), _text(o.get('resource')), _text(o.get('fulfillment')),
+            _text(o.get('user')), _text(o.get('device')),
+            received, json.dumps(o, sort_keys=True))
+
+
+class pending(object):
+    """ A parsed post waiting for the writer """
+    __slots__ = ('row', 'done', 'stored')
+
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.stored = None
+
+
+class store(object):
+    """ Batches notification rows into the sqlite file and publishes new ones """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue(queue_size)
+        self.published = threading.Condition()
+        self.conn = connect(path)
+        create_tables(self.conn)
+        self.last_id = self.conn.execute('SELECT COALESCE(MAX(id), 0) FROM notification').fetchone()[0]
+        self.counts = {'received': 0, 'stored': 0, 'duplicates': 0, 'batches': 0, 'rejected': 0}
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def add(self, row):
+        """ Queue a row and wait for it to commit; returns False if it was a duplicate """
+        p = pending(row)
+        try:
+            self.queue.put_nowait(p)
+        except queue.Full:
+            raise NotifyError('receiver busy', 503)
+        self.count('received')
+        if not p.done.wait(commit_timeout):
+            raise NotifyError('timed out storing notification', 503)
+        if p.stored is None:
+            raise NotifyError('failed storing notification', 500)
+        return p.stored
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='notification-writer')
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + batch_wait
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    def write(self, batch):
+        try:
+            c = self.conn.cursor()
+            stored = []
+            for p in batch:
+                c.execute(insert_sql, p.row)
+                stored.append(c.rowcount == 1)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print('storing notifications: %s' % e, file=sys.stderr)
+            self.conn.rollback()
+            for p in batch:
+                p.done.set()
+            return
+        new = sum(stored)
+        with self.lock:
+            self.counts['batches'] += 1
+            self.counts['stored'] += new
+            self.counts['duplicates'] += len(batch) - new
+        for p, s in zip(batch, stored):
+            p.stored = s
+            p.done.set()
+        if new:
+            with self.published:
+                self.last_id = self.conn.execute('SELECT MAX(id) FROM notification').fetchone()[0]
+                self.published.notify_all()
+
+    def events(self, after, limit, wait=0):
+        """ Notifications with id > after, waiting up to 'wait' seconds for one """
+        if wait > 0:
+            deadline = time.time() + wait
+            with self.published:
+                while self.last_id <= after and time.time() < deadline:
+                    self.published.wait(deadline - time.time())
+        conn = connect(self.path)
+        try:
+            rows = conn.execute('SELECT ' + ', '.join(event_columns) + ' FROM notification'
+                                ' WHERE id > ? ORDER BY id LIMIT ?', (after, limit)).fetchall()
+        finally:
+            conn.close()
+        events = []
+        for row in rows:
+            e = dict(zip(event_columns, row))
+            e['body'] = json.loads(e['body'])
+            events.append(e)
+        return events
+
+
+def _int_arg(args, name, default, lo, hi):
+    try:
+        v = int(args.get(name, [default])[0])
+    except ValueError:
+        raise NotifyError('%s must be an integer' % name)
+    return max(lo, min(hi, v))
+
+
+class handler(BaseHTTPRequestHandler):
+    store = None
+    secret = None
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if urlparse(self.path).path.rstrip('/') != '/notify':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            stored = self.store.add(parse(body, self.secret))
+            self.send_json(200, {'stored': stored})
+        except NotifyError as e:
+            if e.status < 500:
+                self.store.count('rejected')
+            self.send_json(e.status, {'error': str(e)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            with self.store.lock:
+                stats = dict(self.store.counts)
+            stats['queued'] = self.store.queue.qsize()
+            stats['last_id'] = self.store.last_id
+            return self.send_json(200, stats)
+        if url.path != '/events':
+            return self.send_json(404, {'error': 'not found'})
+        args = parse_qs(url.query)
+        try:
+            after = _int_arg(args, 'after', 0, 0, sys.maxsize)
+            limit = _int_arg(args, 'limit', 100, 1, max_events_page)
+            wait = _int_arg(args, 'wait', 0, 0, max_events_wait)
+        except NotifyError as e:
+            return self.send_json(e.status, {'error': str(e)})
+        events = self.store.events(after, limit, wait)
+        self.send_json(200, {'events': events,
+                             'last': events[-1]['id'] if events else after})
+
+    def log_message(self, format, *args):
+        if debug:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class threaded_server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options] SQLITE_FILE',
+                                   description='Receive and store ACS4 notifyURL posts.')
+    parser.add_option('--listen',
+                      action='store',
+                      default='127.0.0.1:8082',
+                      help='host:port to serve on (default 127.0.0.1:8082)')
+    parser.add_option('--secret',
+                      action='store',
+                      help='Distributor sharedSecret; refuse posts with a bad hmac')
+    parser.add_option('-d', '--debug',
+                      action='store_true',
+                      help='Log requests')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('Please supply the sqlite file to store notifications in')
+    if opts.debug:
+        global debug
+        debug = True
+
+    handler.store = store(args[0])
+    handler.store.start()
+    handler.secret = opts.secret
+    host, _, port = opts.listen.rpartition(':')
+    httpd = threaded_server((host or '', int(port)), handler)
+    print('receiving notifications on %s' % opts.listen)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,127 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Opt-in profiling of bss requests and acs4.post() calls.
+
+Off unless a profile directory is given in the environment:
+
+BSS_PROFILE_DIR=/tmp/bss-profiles      bss requests
+ACS4_PROFILE_DIR=/tmp/acs4-profiles    acs4.post() calls (or acs4cmd.py --profile=DIR)
+
+and then, with the same prefix:
+
+_RATE=0.01     fraction of calls to profile (default 0.01)
+_MEMORY=1      also record the top allocations, with tracemalloc.
+               Tracing slows every call down, profiled or not.
+_TOKEN=secret  bss only: a request with ?profile=secret is always
+               profiled.  With a token and no _RATE, only those are.
+
+Each profiled call leaves NAME.TIME.PID.N.prof (load it with pstats or
+snakeviz) and NAME.TIME.PID.N.txt, the top functions by cumulative
+time and, with _MEMORY, the top allocating lines.  With profiling off,
+the cost is a check for None.
+
+Only one call per process is profiled at a time - cProfile can't run
+overlapping sessions - so a sampled call that arrives while another
+is being profiled just runs.  Failing to write a profile is logged to
+stderr; it never fails the call.
+
+"""
+from __future__ import print_function
+
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+# functions and allocation sites listed in each .txt summary
+summary_lines = 30
+
+# fraction of calls profiled when PREFIX_RATE isn't set
+default_rate = 0.01
+
+# held while any profiler in this process is profiling a call
+_running = threading.Lock()
+
+
+class profiler(object):
+
+    def __init__(self, directory, rate=1.0, memory=False, token=None):
+        self.directory = directory
+        self.rate = rate
+        self.token = token
+        self.memory = memory and tracemalloc is not None
+        self.lock = threading.Lock()
+        self.count = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def sample(self):
+        """ True for the fraction of calls that should be profiled """
+        return self.rate >= 1 or (self.rate > 0 and random.random() < self.rate)
+
+    def run(self, name, func, *args, **kw):
+        """
+        Call func, writing its profile under 'name' - unless another
+        call is being profiled, when func just runs.
+        """
+        if not _running.acquire(False):
+            return func(*args, **kw)
+        try:
+            before = tracemalloc.take_snapshot() if self.memory else None
+            prof = cProfile.Profile()
+            start = time.time()
+            try:
+                return prof.runcall(func, *args, **kw)
+            finally:
+                elapsed = time.time() - start
+                after = tracemalloc.take_snapshot() if self.memory else None
+                try:
+                    self.write(name, prof, elapsed, before, after)
+                except Exception as e:
+                    print('acs4profile: writing %s: %s' % (name, e), file=sys.stderr)
+        finally:
+            _running.release()
+
+    def write(self, name, prof, elapsed, before=None, after=None):
+        with self.lock:
+            self.count += 1
+            n = self.count
+        base = os.path.join(self.directory, '%s.%s.%d.%d' % (
+                name, time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid(), n))
+        prof.dump_stats(base + '.prof')
+
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        out.write('%s took %.3fs\n\n' % (name, elapsed))
+        pstats.Stats(prof, stream=out).sort_stats('cumulative').print_stats(summary_lines)
+        if before is not None and after is not None:
+            out.write('Top allocations:\n')
+            for stat in after.compare_to(before, 'lineno')[:summary_lines]:
+                out.write('%s\n' % stat)
+        with open(base + '.txt', 'w') as f:
+            f.write(out.getvalue())
+
+
+def from_env(prefix):
+    """ A profiler configured by PREFIX_DIR etc., or None if PREFIX_DIR isn't set """
+    directory = os.environ.get(prefix + '_DIR')
+    if not directory:
+        return None
+    token = os.environ.get(prefix + '_TOKEN') or None
+    rate = os.environ.get(prefix + '_RATE')
+    if rate is None:
+        rate = 0 if token else default_rate
+    return profiler(directory, rate=float(rate),
+                    memory=os.environ.get(prefix + '_MEMORY', '') not in ('', '0'),
+                    token=token)
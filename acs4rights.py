@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Bring ACS4 DistributionRights in line with a desired-state file,
+sending only the creates and updates that are actually needed.
+
+python acs4rights.py SERVER rights.json --password=PW --dry_run    # show the diff
+python acs4rights.py SERVER rights.json --password=PW              # apply it
+
+rights.json is a JSON list (or one JSON object per line) of
+
+{"resource": "urn:uuid:...", "distributor": "urn:uuid:...",
+ "distributionType": "loan", "available": 1, "returnable": true,
+ "permissions": "sample_permissions.xml"}
+
+permissions may be an xml string, a dict as returned by acs4.request,
+or the name of an xml file (relative to the desired-state file).
+notifyURL and userType may also be given; fields left out of a record
+are not compared, and keep their current values on update (ACS4
+nulls anything an update omits).
+
+Current rights are fetched a page at a time for each distributor
+named in the file.  Rights present in ACS4 but not in the file are
+reported, never deleted.
+
+"""
+from __future__ import print_function
+
+import json
+import optparse
+import os
+import sys
+import threading
+
+import acs4
+
+try:  # Python 3
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+key_fields = ('distributor', 'resource')
+compared_fields = ('distributionType', 'available', 'returnable', 'userType', 'notifyURL', 'permissions')
+
+page_size = 500
+
+
+def normalize_permissions(perms):
+    """ Permissions as a dict, whether given as xml, a dict or None """
+    if perms is None or isinstance(perms, dict):
+        return perms or None
+    return acs4.el_to_o(acs4.read_xml(perms, 'permissions')) or None
+
+
+def normalize(field, value):
+    if field == 'permissions':
+        return normalize_permissions(value)
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    value = acs4.unicode(value).strip()
+    if field == 'returnable':
+        return value.lower()
+    return value
+
+
+def read_desired(path):
+    """ Returns {(distributor, resource): record} from a desired-state file """
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        records = json.loads(text)
+    else:
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+    base = os.path.dirname(os.path.abspath(path))
+    perms_files = {}
+    desired = {}
+    for r in records:
+        if not all(r.get(k) for k in key_fields):
+            raise acs4.Acs4Exception('record without distributor and resource: %r' % (r, ))
+        perms = r.get('permissions')
+        if isinstance(perms, acs4.basestring) and not perms.lstrip().startswith('<'):
+            if perms not in perms_files:
+                with open(os.path.join(base, perms)) as pf:
+                    perms_files[perms] = pf.read()
+            r = dict(r, permissions=perms_files[perms])
+        desired[(r['distributor'], r['resource'])] = r
+    return desired
+
+
+def fetch_current(server, password, distributor, port=acs4.defaultport):
+    """ Returns {(distributor, resource): rights dict} for one distributor """
+    current = {}
+    start = 0
+    while True:
+        page = acs4.request(server, 'DistributionRights', 'get', {'distributor': distributor},
+                            password, start=start, count=page_size, port=port)
+        if not page:
+            break
+        for r in page:
+            current[(r.get('distributor'), r.get('resource'))] = r
+        if len(page) < page_size:
+            break
+        start += len(page)
+    return current
+
+
+def diff(desired, current):
+    """ Field-by-field differences: {field: (current, desired)} for fields in desired """
+    changes = {}
+    for field in compared_fields:
+        if field not in desired:
+            continue
+        want = normalize(field, desired[field])
+        have = normalize(field, current.get(field)) if current is not None else None
+        if want != have:
+            changes[field] = (have, want)
+    return changes
+
+
+def request_args(record):
+    """ A record as request() args; request() skips falsy values, so available=0 must be '0' """
+    return dict((k, v if k == 'permissions' else normalize(k, v)) for k, v in record.items())
+
+
+def plan(desired, current):
+    """ Returns (creates, updates, unchanged, unmanaged) """
+    creates, updates, unchanged = [], [], []
+    for key, want in sorted(desired.items()):
+        have = current.get(key)
+        if have is None:
+            creates.append((request_args(want), diff(want, None)))
+            continue
+        changes = diff(want, have)
+        if changes:
+            # an update nulls any field it leaves out, so send the whole
+            # current record with just the changed fields replaced
+            merged = dict(have)
+            for field in changes:
+                merged[field] = want[field]
+            updates.append((request_args(merged), changes))
+        else:
+            unchanged.append(key)
+    unmanaged = sorted(k for k in current if k not in desired)
+    return creates, updates, unchanged, unmanaged
+
+
+def _show(v):
+    if isinstance(v, dict):
+        return json.dumps(v, sort_keys=True)
+    return 'null' if v is None else v
+
+
+def report(creates, updates, unchanged, unmanaged, out=sys.stdout):
+    for action, items in (('create', creates), ('update', updates)):
+        for record, changes in items:
+            print('%s %s %s' % (action, record['distributor'], record['resource']), file=out)
+            for field, (have, want) in sorted(changes.items()):
+                print('    %s: %s -> %s' % (field, _show(have), _show(want)), file=out)
+    for distributor, resource in unmanaged:
+        print('unmanaged %s %s' % (distributor, resource), file=out)
+    print('%d to create, %d to update, %d unchanged, %d unmanaged'
+          % (len(creates), len(updates), len(unchanged), len(unmanaged)), file=out)
+
+
+def apply(server, password, changes, workers=4, port=acs4.defaultport):
+    """ Send (action, record) pairs from a pool of threads; returns the failures """
+    q = queue.Queue()
+    for item in changes:
+        q.put(item)
+    failures = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                action, record = q.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                acs4.request(server, 'DistributionRights', action, record, password, port=port)
+            except Exception as e:
+                with lock:
+                    failures.append((action, record, e))
+                print('%s %s: %s' % (action, record['resource'], e), file=sys.stderr)
+
+    threads = [threading.Thread(target=work) for i in range(max(1, workers))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failures
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options] SERVER DESIRED_STATE_FILE',
+                                   description='Reconcile ACS4 DistributionRights with a desired-state file.')
+    parser.add_option('-p', '--password',
+                      action='store',
+                      help='ACS4 password')
+    parser.add_option('--port',
+                      action='store',
+                      type='int',
+                      default=acs4.defaultport,
+                      help='Server port to use (default 8080)')
+    parser.add_option('-j', '--workers',
+                      action='store',
+                      type='int',
+                      default=4,
+                      help='Concurrent create/update requests (default 4)')
+    parser.add_option('--dry_run',
+                      action='store_true',
+                      help='Only report what would change')
+    parser.add_option('-d', '--debug',
+                      action='store_true',
+                      help='Print debugging output')
+    opts, args = parser.parse_args(argv)
+
+    if not opts.password:
+        parser.error('We think a password arg might be required')
+    if len(args) != 2:
+        parser.error('Please supply server and desired-state file')
+    if opts.debug:
+        acs4.debug = True
+    server = args[0]
+
+    desired = read_desired(args[1])
+    current = {}
+    for distributor in sorted(set(d for d, r in desired)):
+        current.update(fetch_current(server, opts.password, distributor, port=opts.port))
+
+    creates, updates, unchanged, unmanaged = plan(desired, current)
+    report(creates, updates, unchanged, unmanaged)
+    if opts.dry_run:
+        return
+
+    changes = ([('create', r) for r, c in creates] +
+               [('update', r) for r, c in updates])
+    failures = apply(server, opts.password, changes, workers=opts.workers, port=opts.port)
+    print('%d sent, %d failed' % (len(changes) - len(failures), len(failures)))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
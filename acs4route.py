@@ -0,0 +1,203 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Route acs4 calls across several ACS4 servers.
+
+Each distributor lives on one server; resources are found through an
+explicit table, or failing that, a consistent-hash ring over the
+servers.  Calls naming a distributor or resource go to that one
+server; queryresourceitems and request 'get' calls that name neither
+are sent to every server at once, and the replies merged into one
+stream as they arrive.
+
+import acs4route
+r = acs4route.router.from_file('acs4nodes.json')
+r.request('DistributionRights', 'get', {'distributor': DIST})     # one server
+for item in r.queryresourceitems():                                # all servers
+    print(item['server'], item['resource'])
+
+acs4nodes.json:
+
+{
+    "nodes": {
+        "east": {"server": "acs4-east.example.org", "port": 8080, "password": "..."},
+        "west": {"server": "acs4-west.example.org", "password": "..."}
+    },
+    "distributors": {"urn:uuid:...": "east"},
+    "resources": {"urn:uuid:...": "west"}
+}
+
+"""
+import bisect
+import hashlib
+import json
+import threading
+
+import acs4
+
+try:  # Python 3
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+# points per node on the hash ring
+ring_replicas = 64
+
+
+class node(object):
+    def __init__(self, name, server, password, port=acs4.defaultport):
+        self.name = name
+        self.server = server
+        self.password = password
+        self.port = port
+
+    def __repr__(self):
+        return 'node(%r, %s:%s)' % (self.name, self.server, self.port)
+
+
+def _hash(s):
+    return int(hashlib.md5(s.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class ring(object):
+    """ Consistent hashing of keys onto node names """
+
+    def __init__(self, names, replicas=ring_replicas):
+        points = sorted((_hash('%s#%d' % (name, i)), name)
+                        for name in names for i in range(replicas))
+        self.hashes = [h for h, name in points]
+        self.names = [name for h, name in points]
+
+    def lookup(self, key):
+        i = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.names[i]
+
+
+class router(object):
+
+    def __init__(self, nodes, distributors=None, resources=None):
+        if not nodes:
+            raise acs4.Acs4Exception('router needs at least one node')
+        self.nodes = dict((n.name, n) for n in nodes)
+        self.distributors = dict(distributors or {})
+        self.resources = dict(resources or {})
+        for name in list(self.distributors.values()) + list(self.resources.values()):
+            if name not in self.nodes:
+                raise acs4.Acs4Exception('routing table names unknown node %s' % name)
+        self.ring = ring(sorted(self.nodes))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        nodes = [node(name, n['server'], n['password'], n.get('port', acs4.defaultport))
+                 for name, n in sorted(config['nodes'].items())]
+        return cls(nodes, config.get('distributors'), config.get('resources'))
+
+    def for_distributor(self, distributor):
+        try:
+            return self.nodes[self.distributors[distributor]]
+        except KeyError:
+            raise acs4.Acs4Exception('no server for distributor %s' % distributor)
+
+    def for_resource(self, resource):
+        name = self.resources.get(resource)
+        if name is None:
+            name = self.ring.lookup(resource)
+        return self.nodes[name]
+
+    def route(self, distributor=None, resource=None):
+        """ The node for a call, or None if it should go to all of them """
+        if distributor:
+            return self.for_distributor(distributor)
+        if resource:
+            return self.for_resource(resource)
+        return None
+
+    def fanout(self, call, skip_errors=False):
+        """
+        Run call(node) against every node at once, generating
+        (node, result) pairs in the order they finish.  Failures are
+        raised after the other nodes' results, unless skip_errors.
+        """
+        results = queue.Queue()
+
+        def run(n):
+            try:
+                results.put((n, call(n), None))
+            except Exception as e:
+                results.put((n, None, e))
+
+        for n in self.nodes.values():
+            t = threading.Thread(target=run, args=(n, ))
+            t.daemon = True
+            t.start()
+        errors = []
+        for i in range(len(self.nodes)):
+            n, result, error = results.get()
+            if error is not None:
+                errors.append('%s: %s' % (n.name, error))
+                continue
+            yield n, result
+        if errors and not skip_errors:
+            raise acs4.Acs4Exception('failed on ' + '; '.join(sorted(errors)))
+
+    def _merged(self, call, skip_errors):
+        for n, items in self.fanout(call, skip_errors):
+            for item in items or ():
+                item['server'] = n.name
+                yield item
+
+    def queryresourceitems(self, start=0, count=10, distributor=None, skip_errors=False):
+        """
+        Generates resource items; from one server given a distributor,
+        otherwise from all of them, each item tagged with its 'server'.
+        start and count apply per server.
+        """
+        def call(n):
+            return acs4.queryresourceitems(n.server, n.password, start=start, count=count,
+                                           distributor=distributor, port=n.port)
+        if distributor:
+            items = call(self.for_distributor(distributor)) or []
+            return iter(items)
+        return self._merged(call, skip_errors)
+
+    def request(self, api, action, request_args, start=0, count=0, permissions=None,
+                skip_errors=False):
+        """
+        acs4.request on the server owning the distributor or resource
+        in request_args.  A 'get' or 'count' naming neither goes to
+        every server: 'get' generates the merged items (tagged with
+        'server'), 'count' returns the total.
+        """
+        def call(n):
+            return acs4.request(n.server, api, action, request_args, n.password,
+                                start=start, count=count, permissions=permissions, port=n.port)
+        n = self.route(request_args.get('distributor'), request_args.get('resource'))
+        if n is not None:
+            return call(n)
+        if action == 'get':
+            return self._merged(call, skip_errors)
+        if action == 'count':
+            return sum(c or 0 for n, c in self.fanout(call, skip_errors))
+        raise acs4.Acs4Exception('%s %s needs a distributor or resource to route by' % (api, action))
+
+    def upload(self, filehandle, distributor, **kw):
+        """
+        acs4.upload on the distributor's server.  The new resource is
+        added to the routing table, so later calls naming it find it.
+        """
+        n = self.for_distributor(distributor)
+        result = acs4.upload(n.server, filehandle, n.password, port=n.port, **kw)
+        if isinstance(result, dict) and result.get('resource'):
+            self.resources[result['resource']] = n.name
+        return result
+
+    def get_distributor_info(self, distributor):
+        n = self.for_distributor(distributor)
+        return acs4.get_distributor_info(n.server, n.password, distributor, port=n.port)
+
+    def mint(self, secret, resource, action, ordersource, distributor, **kw):
+        """ acs4.mint, with the link pointing at the distributor's server """
+        n = self.for_distributor(distributor)
+        return acs4.mint(n.server, secret, resource, action, ordersource, port=n.port, **kw)
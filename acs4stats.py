@@ -0,0 +1,14 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Latency summaries shared by acs4mint.py's /stats and acs4bench.py.
+
+"""
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[k]
@@ -1,16 +1,67 @@
 #!/usr/bin/env python
 
+import base64
+import binascii
+import datetime
+import gzip
+import hashlib
+import hmac
+import io
 import json
+import math
+import os
+import re
+import sqlite3
 import sys
+import threading
+import time
 import uuid
 import warnings
 
 # import cgitb; cgitb.enable()
-import MySQLdb
+try:
+    import MySQLdb
+except ImportError:  # only the sqlite backend is usable
+    MySQLdb = None
+try:
+    import msgpack
+except ImportError:  # no msgpack output format
+    msgpack = None
 import web
 
+import acs4profile
+import bssmetrics
+
 warnings.filterwarnings("ignore", message="the sets module is deprecated")
 
+# upper bound on the 'limit' argument for paged listings
+max_page_size = 10000
+
+# Serve is_loaned_out from the tables kept by bssloanstate.py, as long
+# as it has refreshed them within loan_state_max_age seconds.
+use_loan_state = False
+loan_state_max_age = 60
+
+# /changes/ long-polls: longest wait allowed, and how often to look for
+# new events while waiting
+max_change_wait = 30
+change_poll_interval = 1
+
+# Cache-Control max-age, in seconds, for responses that change when a
+# book is lent (shortened to the next loan expiry) and for the rest
+loan_cache_age = 30
+resource_cache_age = 300
+
+# responses smaller than this aren't worth gzipping
+gzip_min_size = 1024
+
+# The full-text index bsssearch.py keeps, for /search/; results past
+# max_search_results aren't paged to, and queries use at most
+# max_search_terms words.
+search_index = os.environ.get('BSS_SEARCH_INDEX', '/var/lib/bss/search.db')
+max_search_results = 1000
+max_search_terms = 10
+
 
 #def cgidebugerror():
 #    """
@@ -29,11 +80,65 @@ urls = (
   '/resource_info_by_id/?(.*)', 'resource_info_by_id', # must precede below
   '/resource_info/?(.*)', 'resource_info',
   '/transaction_info/?(.*)', 'transaction_info',
+  '/loan_state/?(.*)', 'loan_state',
+  '/availability/(.*)', 'availability',
+  '/changes/?(.*)', 'changes',
+  '/search/?(.*)', 'search',
+  '/metrics', 'metrics',
   '/item/(.*)', 'item',
 )
 
 app = web.application(urls, globals())
 
+handler_names = urls[1::2]
+
+def _handler_name():
+    name = web.ctx.path.split('/')[1] if web.ctx.path.count('/') else ''
+    if name not in handler_names:
+        name = 'other'
+    return name
+
+def _metrics_processor(handler):
+    """ Count and time each request, by handler """
+    name = _handler_name()
+    result = None
+    failed = False
+    start = time.time()
+    try:
+        result = handler()
+        return result
+    except web.HTTPError:
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        status = '500' if failed else web.ctx.status.split()[0]
+        labels = (('handler', name), )
+        bssmetrics.inc('bss_requests_total', labels + (('status', status), ))
+        bssmetrics.observe('bss_request_seconds', time.time() - start, labels)
+        if isinstance(result, (bytes, str)):
+            bssmetrics.observe('bss_response_bytes', len(result), labels, bssmetrics.size_buckets)
+
+app.add_processor(_metrics_processor)
+
+# profiles a sample of requests; see acs4profile.py for BSS_PROFILE_DIR etc.
+profiler = acs4profile.from_env('BSS_PROFILE')
+
+def _profile_processor(handler):
+    """ Profile a sample of requests, and those with ?profile=BSS_PROFILE_TOKEN """
+    if profiler is None:
+        return handler()
+    forced = False
+    if profiler.token:
+        given = web.input(profile='').profile
+        forced = bool(given) and hmac.compare_digest(given.encode('utf-8'), profiler.token.encode('utf-8'))
+    if forced or profiler.sample():
+        return profiler.run('bss_' + _handler_name(), handler)
+    return handler()
+
+app.add_processor(_profile_processor)
+
 dbschema = """
 
 mysql> show databases;
@@ -102,17 +207,187 @@ mysql> describe fulfillmentitem;
 mysql> Bye
 """
 
-class acs4db():
+sqlite_schema = """
+-- The adept tables bss reads, for the sqlite backend.  fulfillment and
+-- fulfillmentitem follow dbschema above; resourceitem and
+-- distributionrights have the columns bss and its clients use.
+CREATE TABLE IF NOT EXISTS fulfillment (
+    fulfillmentid binary(20) NOT NULL PRIMARY KEY,
+    distid binary(16) NOT NULL,
+    transid varchar(127) NOT NULL,
+    transtime datetime NOT NULL,
+    signref binary(20) NOT NULL,
+    loanuntil datetime,
+    userid binary(16) NOT NULL,
+    confirmed char(1),
+    returnable char(1),
+    returned char(1)
+);
+CREATE INDEX IF NOT EXISTS fulfillment_transid ON fulfillment (transid);
+CREATE INDEX IF NOT EXISTS fulfillment_transtime ON fulfillment (transtime);
+CREATE INDEX IF NOT EXISTS fulfillment_loanuntil ON fulfillment (loanuntil, returned);
+CREATE TABLE IF NOT EXISTS fulfillmentitem (
+    fulfillmentid binary(20) NOT NULL,
+    resourceid binary(16) NOT NULL,
+    until datetime,
+    permissions blob
+);
+CREATE INDEX IF NOT EXISTS fulfillmentitem_fulfillmentid ON fulfillmentitem (fulfillmentid);
+CREATE INDEX IF NOT EXISTS fulfillmentitem_resourceid ON fulfillmentitem (resourceid, fulfillmentid, until);
+CREATE TABLE IF NOT EXISTS resourceitem (
+    resourceid binary(16) NOT NULL PRIMARY KEY,
+    item int NOT NULL DEFAULT 1,
+    identifier varchar(255),
+    title varchar(255),
+    creator varchar(255),
+    publisher varchar(255),
+    language varchar(32),
+    format varchar(64),
+    src varchar(255),
+    size int
+);
+CREATE INDEX IF NOT EXISTS resourceitem_identifier ON resourceitem (identifier, format);
+CREATE INDEX IF NOT EXISTS resourceitem_title ON resourceitem (title, resourceid);
+CREATE TABLE IF NOT EXISTS distributionrights (
+    distid binary(16) NOT NULL,
+    resourceid binary(16) NOT NULL,
+    distributiontype varchar(16),
+    available int,
+    returnable char(1),
+    usertype varchar(16),
+    permissions blob,
+    notifyurl varchar(255),
+    PRIMARY KEY (distid, resourceid)
+);
+CREATE INDEX IF NOT EXISTS distributionrights_resourceid ON distributionrights (resourceid);
+CREATE TABLE IF NOT EXISTS bss_activeloan (
+    fulfillmentid binary(20) NOT NULL,
+    resourceid binary(16) NOT NULL,
+    transid varchar(127) NOT NULL,
+    transtime datetime NOT NULL,
+    until datetime,
+    loanuntil datetime,
+    returned char(1),
+    PRIMARY KEY (fulfillmentid, resourceid)
+);
+CREATE TABLE IF NOT EXISTS bss_loanevent (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event varchar(16) NOT NULL,
+    resourceid binary(16) NOT NULL,
+    transid varchar(127) NOT NULL,
+    eventtime datetime NOT NULL,
+    recorded datetime NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bss_loanstate (
+    resourceid binary(16) NOT NULL PRIMARY KEY,
+    active_loans int NOT NULL,
+    earliest_loanuntil datetime,
+    latest_loanuntil datetime,
+    last_transid varchar(127),
+    last_transtime datetime
+);
+CREATE TABLE IF NOT EXISTS bss_watermark (
+    name varchar(32) NOT NULL PRIMARY KEY,
+    value datetime NOT NULL,
+    refreshed datetime NOT NULL
+);
+"""
+
+
+class db_backend:
+    """
+    Where acs4db gets its connections.  Under CGI every request is a
+    fresh process; under WSGI (bsswsgi.py) each worker thread keeps its
+    connection here and reuses it across requests.
+
+    Subclasses supply connect(timeout=None), ping(), execute(),
+    replication_lag() and Error.
+    """
+
+    name = ''
 
     def __init__(self):
-        pass
+        self.local = threading.local()
+        # as a read replica: last replication lag seen, when it was
+        # checked, and queries running; the lag is checked by one
+        # thread at a time, on a connection of its own
+        self.lag = None
+        self.lag_checked = 0
+        self.lag_lock = threading.Lock()
+        self.lag_conn = None
+        self.busy = 0
+
+    def connection(self):
+        """ Returns this thread's connection, reconnecting if it has gone away """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            try:
+                self.ping(conn)
+                return conn
+            except self.Error:
+                self.local.conn = None
+                bssmetrics.inc('bss_db_reconnects_total')
+        conn = self.connect()
+        bssmetrics.inc('bss_db_connects_total')
+        self.local.conn = conn
+        return conn
+
+    def lag_connection(self):
+        """
+        The connection replication lag is checked on.  A replica that's
+        down costs one connect attempt of replica_connect_timeout
+        seconds, not the retries connection() makes.  Call with
+        lag_lock held.
+        """
+        if self.lag_conn is not None:
+            try:
+                self.ping(self.lag_conn)
+                return self.lag_conn
+            except self.Error:
+                self.lag_conn = None
+        self.lag_conn = self.connect(timeout=replica_connect_timeout)
+        bssmetrics.inc('bss_db_connects_total')
+        return self.lag_conn
+
+    def release(self, conn):
+        """ Close a connection, forgetting it if it's this thread's """
+        if getattr(self.local, 'conn', None) is conn:
+            self.local.conn = None
+        conn.close()
 
-    def connect(self):
-        host = '127.0.0.1'
-        db = 'adept'
-        user = 'root'
-        pw_file = open('/usr/local/bss/db-password', 'r')
+    def close(self):
+        """ Close this thread's connection, if any """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.release(conn)
+
+
+class mysql_backend(db_backend):
+    """ The adept MySQL database ACS4 itself uses - the default """
+
+    host = '127.0.0.1'
+    db = 'adept'
+    user = 'root'
+    password_file = '/usr/local/bss/db-password'
+
+    def __init__(self, host=None):
+        db_backend.__init__(self)
+        if host is not None:
+            self.host = host
+
+    @property
+    def name(self):
+        return self.host
+
+    @property
+    def Error(self):
+        return MySQLdb.Error
+
+    def connect(self, timeout=None):
+        """ With a timeout, make one attempt that gives up after that many seconds """
+        pw_file = open(self.password_file, 'r')
         passwd = pw_file.readline().rstrip("\n")
+        pw_file.close()
 
         # retry the connect because mysql server at IA sometimes causes this
         # exception:
@@ -124,75 +399,260 @@ class acs4db():
 
         try_count = 1
         max_tries = 5
-        self.conn = None
-        while (not self.conn) and (try_count <= max_tries):
+        kw = {}
+        if timeout is not None:
+            max_tries = 1
+            kw = {'connect_timeout': int(math.ceil(timeout)),
+                  'read_timeout': int(math.ceil(timeout))}
+        conn = None
+        while (not conn) and (try_count <= max_tries):
             try:
                 try_count = try_count + 1
-                self.conn =  MySQLdb.connect(
-                    host=host,
-                    db=db,
-                    user=user,
+                conn =  MySQLdb.connect(
+                    host=self.host,
+                    db=self.db,
+                    user=self.user,
                     passwd=passwd,
+                    **kw
                     )
             except MySQLdb.OperationalError as e:
                 if try_count > max_tries:
+                    bssmetrics.inc('bss_db_connect_failures_total')
                     raise e
-        self.conn.set_character_set('utf8')
+                bssmetrics.inc('bss_db_connect_retries_total')
+        conn.set_character_set('utf8')
+        # Connections outlive requests under WSGI; without autocommit,
+        # InnoDB would keep answering from the snapshot the first
+        # SELECT took.  Writers wrap their work in BEGIN / commit().
+        conn.autocommit(True)
+        return conn
 
-    def close(self):
-        self.conn.close()
+    def ping(self, conn):
+        conn.ping()
 
+    def execute(self, cursor, sql, args=None):
+        cursor.execute(sql, args)
 
-    def get_fulfillment_info(self, resource=None):
-        """ returns a list of resources in the fulfilment table , values set to dict of handy facts """
+    def replication_lag(self, conn):
+        """ Seconds this replica is behind, or None if replication isn't running """
+        c = conn.cursor()
+        c.execute("SHOW SLAVE STATUS")
+        row = c.fetchone()
+        if row is None:
+            return None
+        status = dict(zip([d[0] for d in c.description], row))
+        return status.get('Seconds_Behind_Master')
 
-        resources = []
 
-        if resource == '':
-            resource = None
+def _sqlite_datetime(s):
+    s = s.decode('ascii')
+    return datetime.datetime.strptime(s[:19], '%Y-%m-%d %H:%M:%S')
 
-        self.connect()
-        c = self.conn.cursor()
-        sql = """
-            SELECT DISTINCT resourceid, returned, until, loanuntil FROM fulfillmentitem, fulfillment
-                WHERE fulfillmentitem.fulfillmentid = fulfillment.fulfillmentid
-        """
+def _sqlite_now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
 
-        if resource:
-            resource_uuid = uuid.UUID(resource)
-            c.execute(sql + " AND fulfillmentitem.resourceid = %s ORDER BY loanuntil DESC", (resource_uuid.bytes, ))
-        else:
-            c.execute(sql + " ORDER BY loanuntil DESC")
+class sqlite_backend(db_backend):
+    """
+    An sqlite file with the tables in sqlite_schema, standing in for
+    MySQL so bss can be run and load-tested offline.  bssfake.py
+    fills one with synthetic data.  Queries are translated from MySQL
+    as they run: %s parameters become ?, INSERT IGNORE becomes INSERT
+    OR IGNORE, and NOW() is UTC.
+    """
 
-        r = c.fetchone()
-        while r != None:
-            r_dict = {}
-            r_dict['resourceid'] = 'urn:uuid:' + str(uuid.UUID(bytes=r[0]))
-            r_dict['returned'] = r[1]
-            if r[2]:
-                r_dict['until'] = r[2].isoformat()
-            else:
-                r_dict['until'] = None
-            if r[3]:
-                r_dict['loanuntil'] = r[3].isoformat()
-            else:
-                r_dict['loanuntil'] = None
-            resources.append(r_dict)
-            r = c.fetchone()
+    Error = sqlite3.Error
 
-        return resources
+    def __init__(self, path):
+        db_backend.__init__(self)
+        self.path = path
+        self.name = path
 
+    def connect(self, timeout=None):
+        kw = {} if timeout is None else {'timeout': timeout}
+        conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, **kw)
+        conn.text_factory = str
+        conn.create_function('NOW', 0, _sqlite_now)
+        return conn
 
-    def get_loaned_out(self, resource=None):
-        """ returns a list of unloanable books (someone else has 'em) according to acs"""
-        resources = []
+    def ping(self, conn):
+        conn.execute('SELECT 1')
 
-        if resource == '':
-            resource = None
+    def execute(self, cursor, sql, args=None):
+        sql = sql.replace('%s', '?').replace('INSERT IGNORE', 'INSERT OR IGNORE')
+        cursor.execute(sql, args or ())
 
-        self.connect()
-        c = self.conn.cursor()
-        sql = """
+    def replication_lag(self, conn):
+        # an sqlite "replica" is a copy of the file, never behind
+        return 0
+
+    def create_tables(self):
+        conn = self.connection()
+        conn.executescript(sqlite_schema)
+        conn.commit()
+
+sqlite3.register_converter('datetime', _sqlite_datetime)
+sqlite3.register_adapter(datetime.datetime, lambda d: d.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def _backend_from_spec(spec):
+    """ sqlite:PATH for an sqlite file, otherwise a MySQL host (or '' for the default) """
+    if spec.startswith('sqlite:'):
+        return sqlite_backend(spec[len('sqlite:'):])
+    return mysql_backend(spec or None)
+
+def _backend_from_env():
+    """ sqlite:PATH in the BSS_DB environment variable selects sqlite """
+    return _backend_from_spec(os.environ.get('BSS_DB', ''))
+
+# the backend acs4db uses unless given another
+default_backend = _backend_from_env()
+
+# Read replicas of the adept database.  BSS_REPLICAS is a comma
+# separated list of MySQL hosts (or sqlite:PATHs).
+replicas = [_backend_from_spec(spec) for spec in os.environ.get('BSS_REPLICAS', '').split(',') if spec]
+
+# 'round_robin', or 'least_loaded' for the replica running fewest queries
+replica_policy = 'round_robin'
+
+# seconds between replication lag checks of a replica
+replica_check_interval = 5
+
+# Seconds a lag check waits to connect to (or hear from) a replica.
+# The check runs inside whichever request finds it due, so a replica
+# that's down must fail fast.
+replica_connect_timeout = 2
+
+# Seconds of replication lag each acs4db query will put up with.
+# Queries not listed always read the primary - in particular
+# loaned_out, which decides whether a book can be lent, and
+# fulfillment_history, whose watermark would move past rows a replica
+# hadn't applied yet.  Listings that are cached for a while anyway can
+# come from a replica that's behind by about as long.
+replica_max_lag = {
+    'resource_info': resource_cache_age,
+    'resource_info_page': resource_cache_age,
+    'resource_info_by_id': resource_cache_age,
+    'fulfillment_info': loan_cache_age,
+    'fulfillment_info_page': loan_cache_age,
+}
+
+_replica_lock = threading.Lock()
+_replica_turn = [0]
+
+def _replica_lag(backend):
+    """
+    A replica's replication lag, rechecked every replica_check_interval;
+    None if it's broken.  While one thread rechecks, the others use the
+    last value rather than wait.
+    """
+    now = time.time()
+    if now - backend.lag_checked >= replica_check_interval and backend.lag_lock.acquire(False):
+        try:
+            backend.lag_checked = now
+            try:
+                backend.lag = backend.replication_lag(backend.lag_connection())
+            except backend.Error:
+                backend.lag = None
+                backend.lag_conn = None
+            bssmetrics.gauge('bss_db_replica_up', int(backend.lag is not None), (('replica', backend.name), ))
+            if backend.lag is not None:
+                bssmetrics.gauge('bss_db_replica_lag_seconds', backend.lag, (('replica', backend.name), ))
+        finally:
+            backend.lag_lock.release()
+    return backend.lag
+
+def _choose_backend(query, primary):
+    """ The backend to run 'query' on: a replica that's recent enough, or the primary """
+    max_lag = replica_max_lag.get(query, 0)
+    if max_lag and replicas:
+        usable = []
+        for r in replicas:
+            lag = _replica_lag(r)
+            if lag is not None and lag <= max_lag:
+                usable.append(r)
+        if usable:
+            if replica_policy == 'least_loaded':
+                return min(usable, key=lambda r: r.busy)
+            with _replica_lock:
+                _replica_turn[0] += 1
+                return usable[_replica_turn[0] % len(usable)]
+    return primary
+
+# rows fetched per round trip when decoding query results
+fetch_size = 1000
+
+def _uuid_urn(b):
+    # same as 'urn:uuid:' + str(uuid.UUID(bytes=b)), without building a UUID
+    h = binascii.hexlify(b).decode('ascii')
+    return 'urn:uuid:%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+def _isoformat(d):
+    # sqlite returns computed datetimes, like MIN(loanuntil), as text
+    if isinstance(d, str):
+        return d.replace(' ', 'T')
+    return d.isoformat()
+
+def _blob_text(b):
+    # blobs are already str under python 2
+    if isinstance(b, str):
+        return b
+    return b.decode('utf-8', 'replace')
+
+# upper bound on identifiers per availability request
+max_availability_ids = 1000
+
+# resourceitem columns a fields= argument may name
+resource_fields = ('resourceid', 'item', 'identifier', 'title', 'creator', 'publisher',
+                   'language', 'format', 'src', 'size')
+
+# Named fields= profiles.  'lean' is the default for paged
+# resource_info listings; 'all' is SELECT *, every column and blob.
+resource_field_profiles = {
+    'lean': ('resourceid', 'identifier', 'title', 'format', 'src'),
+    'all': None,
+}
+
+# binary uuid columns that are handed out as urns
+uuid_columns = ('resourceid', )
+
+# datetime columns, for drivers (sqlite) whose descriptions have no types
+datetime_columns = ('until', 'loanuntil', 'transtime', 'next_free_at', 'eventtime',
+                    'earliest_loanuntil', 'latest_loanuntil', 'last_transtime')
+
+if MySQLdb is not None:
+    datetime_types = (MySQLdb.FIELD_TYPE.DATETIME, MySQLdb.FIELD_TYPE.TIMESTAMP,
+                      MySQLdb.FIELD_TYPE.DATE)
+    blob_types = (MySQLdb.FIELD_TYPE.BLOB, MySQLdb.FIELD_TYPE.TINY_BLOB,
+                  MySQLdb.FIELD_TYPE.MEDIUM_BLOB, MySQLdb.FIELD_TYPE.LONG_BLOB)
+else:
+    datetime_types = blob_types = ()
+
+def _column_converters(description):
+    """ Returns a converter (or None) for each column of a cursor description """
+    converters = []
+    for d in description:
+        name, type_code = d[0], d[1]
+        if name in uuid_columns:
+            converters.append(_uuid_urn)
+        elif type_code in datetime_types or (type_code is None and name in datetime_columns):
+            converters.append(_isoformat)
+        elif type_code in blob_types:
+            converters.append(_blob_text)
+        else:
+            converters.append(None)
+    return converters
+
+class acs4db():
+
+    # The queries behind the bss endpoints.  bssindex.py EXPLAINs
+    # whatever the methods below build from them.
+
+    fulfillment_sql = """
+            SELECT DISTINCT resourceid, returned, until, loanuntil FROM fulfillmentitem, fulfillment
+                WHERE fulfillmentitem.fulfillmentid = fulfillment.fulfillmentid
+        """
+
+    loaned_out_sql = """
             SELECT DISTINCT resourceid, returned, until, loanuntil, transtime, transid FROM fulfillmentitem, fulfillment
                 WHERE fulfillmentitem.fulfillmentid = fulfillment.fulfillmentid
                     AND (
@@ -206,79 +666,383 @@ class acs4db():
                         )
         """
 
+    resource_by_id_sql = """
+            SELECT *
+                FROM resourceitem
+                    WHERE identifier = %s
+                        ORDER BY format
+        """
+
+    transaction_sql = ("SELECT ri.identifier, fi.resourceid, f.transid, f.returned, f.transtime, f.loanuntil"  +
+                       " FROM fulfillmentitem fi, fulfillment f, resourceitem ri" +
+                       " WHERE ri.resourceid=fi.resourceid and fi.fulfillmentid=f.fulfillmentid and f.transid=%s")
+
+    resource_sql = """
+            SELECT *
+                FROM resourceitem
+        """
+
+    # bss_activeloan only holds loans that were active at the last
+    # refresh, so this just rechecks for expiry since then.
+    active_loan_sql = """
+            SELECT DISTINCT resourceid, returned, until, loanuntil, transtime, transid FROM bss_activeloan
+                WHERE ((loanuntil IS NULL OR until IS NULL) OR (loanuntil > NOW()))
+        """
+
+    # One row per resource (format) of the given identifiers: copies
+    # from distributionrights, and the count and earliest expiry of
+    # its active loans.  Takes the identifier placeholders as %s.
+    availability_sql = """
+            SELECT ri.identifier, ri.resourceid, ri.format,
+                    (SELECT COALESCE(SUM(dr.available), 0) FROM distributionrights dr
+                        WHERE dr.resourceid = ri.resourceid) AS copies,
+                    COUNT(f.fulfillmentid) AS loaned,
+                    MIN(f.loanuntil) AS next_free_at
+                FROM resourceitem ri
+                    LEFT JOIN fulfillmentitem fi ON fi.resourceid = ri.resourceid
+                    LEFT JOIN fulfillment f ON f.fulfillmentid = fi.fulfillmentid
+                        AND (
+                                (
+                                    (f.loanuntil IS NULL OR fi.until IS NULL)
+                                    OR
+                                    (f.loanuntil > NOW())
+                                )
+                                AND
+                                ( f.returned IS NULL OR f.returned = 'F')
+                            )
+                WHERE ri.identifier IN (%s)
+                GROUP BY ri.identifier, ri.resourceid, ri.format
+                ORDER BY ri.identifier, ri.format
+        """
+
+    loan_event_sql = """
+            SELECT id, event, resourceid, transid, eventtime
+                FROM bss_loanevent
+        """
+
+    loan_state_sql = """
+            SELECT resourceid, active_loans, earliest_loanuntil, latest_loanuntil, last_transid, last_transtime
+                FROM bss_loanstate
+        """
+
+    # Fulfillment history, one row per fulfillment item, for
+    # bssexport.py.  Walked in (transtime, fulfillmentid, resourceid)
+    # order within a transtime range.
+    history_sql = """
+            SELECT f.transtime, f.transid, f.fulfillmentid, fi.resourceid, f.loanuntil, fi.until,
+                    f.returnable, f.returned, ri.identifier, ri.title, ri.format
+                FROM fulfillment f
+                    JOIN fulfillmentitem fi ON fi.fulfillmentid = f.fulfillmentid
+                    LEFT JOIN resourceitem ri ON ri.resourceid = fi.resourceid
+                WHERE f.transtime > %s AND f.transtime <= %s
+        """
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = default_backend
+        self.backend = backend
+        self.conn_backend = backend
+        self._query = None
+
+    def connect(self, query=None):
+        """
+        Connect for 'query', on a read replica if the query tolerates
+        the replica's lag (see replica_max_lag), else the primary.
+        """
+        backend = self.backend
+        if query is not None and backend is default_backend:
+            backend = _choose_backend(query, backend)
+        self.conn = backend.connection()
+        self.conn_backend = backend
+        if query is not None:
+            target = 'primary' if backend is self.backend else backend.name
+            bssmetrics.inc('bss_db_reads_total', (('query', query), ('target', target)))
+
+    def close(self):
+        self.conn_backend.release(self.conn)
+
+    def _execute(self, query, cursor, sql, args=None):
+        """ Run sql on cursor, timing it as 'query' in bssmetrics """
+        self._query = query
+        backend = self.conn_backend
+        start = time.time()
+        with _replica_lock:
+            backend.busy += 1
+        try:
+            backend.execute(cursor, sql, args)
+        finally:
+            with _replica_lock:
+                backend.busy -= 1
+        bssmetrics.observe('bss_query_seconds', time.time() - start, (('query', query), ))
+
+    def _rows(self, cursor):
+        """
+        Generates a dict per row of the cursor's result, with binary
+        uuids, datetimes and blobs converted for json.
+
+        Rows are fetched in batches, and the column names and
+        converters are worked out once per query rather than per row.
+        """
+        names = [d[0] for d in cursor.description]
+        converted = [(i, names[i], conv)
+                     for i, conv in enumerate(_column_converters(cursor.description))
+                     if conv is not None]
+        labels = (('query', self._query), )
+        count = 0
+        elapsed = 0
+        while True:
+            start = time.time()
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            decoded = []
+            for r in rows:
+                d = dict(zip(names, r))
+                for i, name, conv in converted:
+                    v = r[i]
+                    if v is not None:
+                        d[name] = conv(v)
+                decoded.append(d)
+            count += len(rows)
+            elapsed += time.time() - start
+            for d in decoded:
+                yield d
+        bssmetrics.observe('bss_fetch_seconds', elapsed, labels)
+        bssmetrics.observe('bss_query_rows', count, labels, bssmetrics.row_buckets)
+
+    def get_fulfillment_info(self, resource=None):
+        """ returns a list of resources in the fulfilment table , values set to dict of handy facts """
+
+        if resource == '':
+            resource = None
+
+        self.connect('fulfillment_info')
+        c = self.conn.cursor()
+        sql = self.fulfillment_sql
+
         if resource:
             resource_uuid = uuid.UUID(resource)
-            c.execute(sql + " AND fulfillmentitem.resourceid = %s ORDER BY loanuntil DESC", (resource_uuid.bytes, ))
+            self._execute('fulfillment_info', c, sql + " AND fulfillmentitem.resourceid = %s ORDER BY loanuntil DESC", (resource_uuid.bytes, ))
         else:
-            c.execute(sql + " ORDER BY loanuntil DESC")
+            self._execute('fulfillment_info', c, sql + " ORDER BY loanuntil DESC")
 
-        r = c.fetchone()
-        while r != None:
-            r_dict = {}
-            r_dict['resourceid'] = 'urn:uuid:' + str(uuid.UUID(bytes=r[0]))
-            r_dict['transtime'] = r[-2].isoformat()
-            r_dict['transid'] = r[-1]
-            r_dict['returned'] = r[1]
-            if r[2]:
-                r_dict['until'] = r[2].isoformat()
-            else:
-                r_dict['until'] = None
-            if r[3]:
-                r_dict['loanuntil'] = r[3].isoformat()
-            else:
-                r_dict['loanuntil'] =  None
+        return list(self._rows(c))
 
-            resources.append(r_dict)
-            r = c.fetchone()
 
-        return resources
+    def get_loaned_out(self, resource=None):
+        """ returns a list of unloanable books (someone else has 'em) according to acs"""
 
-    def _fetchone_dict(self, cursor):
-        r = cursor.fetchone()
-        d = {}
-        if r == None:
-            return r
-        for i in range(len(r)):
-            d[cursor.description[i][0]] = r[i]
-            #sys.stderr.write(repr(d[cursor.description[i][0]]) + " = " + repr(r[i]) + "\n")
-        return d
+        if resource == '':
+            resource = None
 
-    def get_resource_info(self, resource=None):
-        """ returns a list of resource entries in the resource table for a given resource """
-        resources = []
+        self.connect('loaned_out')
+        c = self.conn.cursor()
+        if use_loan_state and self._loan_state_fresh():
+            sql = self.active_loan_sql
+        else:
+            sql = self.loaned_out_sql
+
+        if resource:
+            resource_uuid = uuid.UUID(resource)
+            self._execute('loaned_out', c, sql + " AND resourceid = %s ORDER BY loanuntil DESC", (resource_uuid.bytes, ))
+        else:
+            self._execute('loaned_out', c, sql + " ORDER BY loanuntil DESC")
+
+        return list(self._rows(c))
+
+    def _loan_state_fresh(self):
+        """ True if bssloanstate.py has refreshed the loan-state tables recently """
+        c = self.conn.cursor()
+        # refreshed was written from the database's NOW(), so compare it
+        # with that rather than this host's clock or timezone
+        self._execute('loan_state_fresh', c, "SELECT refreshed, NOW() FROM bss_watermark WHERE name = 'loanstate'")
+        r = c.fetchone()
+        if r is None or r[0] is None:
+            return False
+        # sqlite hands back NOW() as text
+        refreshed, now = [v if isinstance(v, datetime.datetime)
+                          else datetime.datetime.strptime(str(v)[:19], '%Y-%m-%d %H:%M:%S')
+                          for v in r]
+        return now - refreshed < datetime.timedelta(seconds=loan_state_max_age)
+
+    def get_loan_state(self, resource=None):
+        """
+        Returns the loan summary kept by bssloanstate.py for a
+        resource, as a list of zero or one entries; or without a
+        resource, the summaries of all resources currently on loan.
+        """
 
         if resource == '':
             resource = None
 
-        self.connect()
+        self.connect('loan_state')
+        c = self.conn.cursor()
+        sql = self.loan_state_sql
+
+        if resource:
+            resource_uuid = uuid.UUID(resource)
+            self._execute('loan_state', c, sql + " WHERE resourceid = %s", (resource_uuid.bytes, ))
+        else:
+            self._execute('loan_state', c, sql + " WHERE active_loans > 0 ORDER BY latest_loanuntil DESC")
+
+        return list(self._rows(c))
+
+    def get_loan_changes(self, limit, cursor=None):
+        """
+        Returns loan events logged by bssloanstate.py after the point
+        'cursor' marks, at most 'limit' of them, as a dict with
+        'changes' and 'next' keys.  Each change has event ('loan',
+        'returned' or 'expired'), resourceid, transid and eventtime.
+
+        Without a cursor there are no changes, just a cursor for the
+        current end of the log to start from.
+        """
+
+        self.connect('loan_changes')
+        c = self.conn.cursor()
+
+        if not cursor:
+            self._execute('loan_changes', c, "SELECT MAX(id) FROM bss_loanevent")
+            last = c.fetchone()[0] or 0
+            return {'changes': [], 'next': _encode_cursor([int(last)])}
+
+        since, = _decode_cursor(cursor, 1)
+        self._execute('loan_changes', c,
+                      self.loan_event_sql + " WHERE id > %s ORDER BY id LIMIT %d" % (int(since), limit))
+        changes = list(self._rows(c))
+        if changes:
+            since = changes[-1]['id']
+        for change in changes:
+            del change['id']
+        return {'changes': changes, 'next': _encode_cursor([since])}
+
+    def get_fulfillment_info_page(self, limit, cursor=None):
+        """
+        Returns a page of at most 'limit' fulfillment entries, and a
+        cursor for the next page (or None at the end), as a dict with
+        'fulfillments' and 'next' keys.
+
+        Pages are walked by keyset on (loanuntil DESC, fulfillmentid,
+        resourceid), so each page costs the same however deep into
+        the table it is.  Unlike get_fulfillment_info(), entries are
+        one per fulfillment item.
+        """
+
+        self.connect('fulfillment_info_page')
         c = self.conn.cursor()
         sql = """
-            SELECT *
-                FROM resourceitem
+            SELECT DISTINCT resourceid, returned, until, loanuntil, fulfillment.fulfillmentid
+                FROM fulfillmentitem, fulfillment
+                WHERE fulfillmentitem.fulfillmentid = fulfillment.fulfillmentid
+        """
+        args = ()
+
+        if cursor:
+            loanuntil, fulfillmentid, resourceid = _decode_cursor(cursor, 3)
+            fulfillmentid = binascii.unhexlify(fulfillmentid)
+            resourceid = binascii.unhexlify(resourceid)
+            after = """(fulfillment.fulfillmentid > %s
+                        OR (fulfillment.fulfillmentid = %s AND resourceid > %s))"""
+            # NULL loanuntil sorts last in descending order
+            if loanuntil is None:
+                sql += " AND (loanuntil IS NULL AND " + after + ")"
+                args = (fulfillmentid, fulfillmentid, resourceid)
+            else:
+                sql += (" AND (loanuntil < %s OR loanuntil IS NULL"
+                        " OR (loanuntil = %s AND " + after + "))")
+                args = (loanuntil, loanuntil, fulfillmentid, fulfillmentid, resourceid)
+
+        sql += " ORDER BY loanuntil DESC, fulfillment.fulfillmentid, resourceid LIMIT %d" % (limit + 1)
+        self._execute('fulfillment_info_page', c, sql, args)
+        fulfillments = list(self._rows(c))
+
+        next_cursor = None
+        if len(fulfillments) > limit:
+            fulfillments = fulfillments[:limit]
+            last = fulfillments[-1]
+            next_cursor = _encode_cursor([
+                    last['loanuntil'].replace('T', ' ') if last['loanuntil'] else None,
+                    binascii.hexlify(last['fulfillmentid']).decode('ascii'),
+                    uuid.UUID(last['resourceid']).hex,
+                    ])
+        for f in fulfillments:
+            del f['fulfillmentid']
+
+        return {'fulfillments': fulfillments, 'next': next_cursor}
+
+    def get_resource_info(self, resource=None, fields=None):
         """
+        returns a list of resource entries in the resource table for a given resource
+
+        'fields' limits the entries to those resourceitem columns;
+        None means all of them.
+        """
+
+        if resource == '':
+            resource = None
+
+        columns, drop = _resource_columns(fields)
+        self.connect('resource_info')
+        c = self.conn.cursor()
+        sql = _project(self.resource_sql, columns)
 
         if resource:
             resource_uuid = uuid.UUID(resource)
-            c.execute(sql + " WHERE resourceid = %s ORDER BY title,resourceid ", (resource_uuid.bytes, ))
+            self._execute('resource_info', c, sql + " WHERE resourceid = %s ORDER BY title,resourceid ", (resource_uuid.bytes, ))
         else:
-            c.execute(sql + " ORDER BY title,resourceid ")
+            self._execute('resource_info', c, sql + " ORDER BY title,resourceid ")
 
-        r = self._fetchone_dict(c)
-        while r != None:
-            r['resourceid'] = 'urn:uuid:' + str(uuid.UUID(bytes=r['resourceid']))
-            resources.append(r)
-            #sys.stderr.write(r['resourceid'] + "\n")
-            #json.dumps(r)
-            r = self._fetchone_dict(c)
+        return _drop_fields(self._rows(c), drop)
 
+    def get_resource_info_page(self, limit, cursor=None, fields=None):
+        """
+        Returns a page of at most 'limit' resource entries, and a
+        cursor for the next page (or None at the end), as a dict with
+        'resources' and 'next' keys.
 
-        return resources
+        Pages are walked by keyset on (title, resourceid), the sort
+        order of get_resource_info().  'fields' is as for
+        get_resource_info().
+        """
+
+        columns, drop = _resource_columns(fields, ('title', 'resourceid'))
+        self.connect('resource_info_page')
+        c = self.conn.cursor()
+        sql = _project(self.resource_sql, columns)
+        args = ()
 
-    def get_resource_info_by_id(self, identifier=None):
+        if cursor:
+            title, resourceid = _decode_cursor(cursor, 2)
+            resourceid = binascii.unhexlify(resourceid)
+            # NULL titles sort first
+            if title is None:
+                sql += " WHERE (title IS NULL AND resourceid > %s) OR title IS NOT NULL"
+                args = (resourceid, )
+            else:
+                sql += " WHERE title > %s OR (title = %s AND resourceid > %s)"
+                args = (title, title, resourceid)
+
+        sql += " ORDER BY title,resourceid LIMIT %d" % (limit + 1)
+        self._execute('resource_info_page', c, sql, args)
+        resources = list(self._rows(c))
+
+        next_cursor = None
+        if len(resources) > limit:
+            resources = resources[:limit]
+            last = resources[-1]
+            next_cursor = _encode_cursor([
+                    last['title'],
+                    uuid.UUID(last['resourceid']).hex,
+                    ])
+
+        return {'resources': _drop_fields(resources, drop), 'next': next_cursor}
+
+    def get_resource_info_by_id(self, identifier=None, fields=None, loanstatus=True):
         """
         Returns a list of resource entries matching a given
         identifier.  Each resource also includes a 'loanstatus' entry
-        (see is_loaned_out) that might be null.
+        (see is_loaned_out) that might be null, unless loanstatus is
+        False.  'fields' is as for get_resource_info().
 
         This depends on the 'identifier' metadata field being set
         appropriately at resource load time.
@@ -289,20 +1053,17 @@ class acs4db():
         if identifier == '' or identifier is None:
             return resources
 
-        self.connect()
+        columns, drop = _resource_columns(fields, ('resourceid', ))
+        self.connect('resource_info_by_id')
         c = self.conn.cursor()
 
-        sql = """
-            SELECT *
-                FROM resourceitem
-                    WHERE identifier = %s
-                        ORDER BY format
-        """
-        c.execute(sql, (identifier, ))
+        sql = _project(self.resource_by_id_sql, columns)
+        self._execute('resource_info_by_id', c, sql, (identifier, ))
 
-        r = self._fetchone_dict(c)
-        while r != None:
-            r['resourceid'] = 'urn:uuid:' + str(uuid.UUID(bytes=r['resourceid']))
+        rows = list(self._rows(c))
+        if not loanstatus:
+            return _drop_fields(rows, drop)
+        for r in rows:
             loanstatuses = self.get_loaned_out(r['resourceid'])
             if len(loanstatuses) > 0:
                 loanstatus = loanstatuses[0]
@@ -310,64 +1071,491 @@ class acs4db():
                 loanstatus = None
             r['loanstatus'] = loanstatus
             resources.append(r)
-            r = self._fetchone_dict(c)
 
+        return _drop_fields(resources, drop)
+
+    def get_availability(self, identifiers):
+        """
+        Returns, for each resource of each of the given identifiers,
+        a dict of its identifier, resourceid and format; 'copies' (the
+        distribution rights 'available' count); 'loaned' (active
+        loans); 'available' (copies not on loan); and 'next_free_at',
+        the earliest loan expiry if no copies are available.
+        """
+
+        identifiers = [i for i in identifiers if i]
+        if not identifiers:
+            return []
+
+        self.connect('availability')
+        c = self.conn.cursor()
+        sql = self.availability_sql % ', '.join(['%s'] * len(identifiers))
+        self._execute('availability', c, sql, tuple(identifiers))
+
+        resources = []
+        for r in self._rows(c):
+            r['copies'] = int(r['copies'])
+            r['available'] = max(r['copies'] - r['loaned'], 0)
+            if r['available'] > 0:
+                r['next_free_at'] = None
+            resources.append(r)
         return resources
 
+    def get_fulfillment_history(self, since, until, limit, after=None):
+        """
+        Returns up to 'limit' fulfillment items with a transtime after
+        'since' and no later than 'until', in transtime order.  'after'
+        is the (transtime, fulfillmentid, resourceid) of the last row
+        of the previous batch, to continue from.  fulfillmentid is
+        left as bytes.
+        """
+
+        self.connect('fulfillment_history')
+        c = self.conn.cursor()
+        sql = self.history_sql
+        args = (since, until)
+        if after is not None:
+            transtime, fulfillmentid, resourceid = after
+            sql += """ AND (f.transtime > %s
+                            OR (f.transtime = %s AND (f.fulfillmentid > %s
+                                OR (f.fulfillmentid = %s AND fi.resourceid > %s))))"""
+            args += (transtime, transtime, fulfillmentid, fulfillmentid, resourceid)
+        sql += " ORDER BY f.transtime, f.fulfillmentid, fi.resourceid LIMIT %d" % limit
+        self._execute('fulfillment_history', c, sql, args)
+        return list(self._rows(c))
+
     def get_transaction_info(self, transid):
-        sql = ("SELECT ri.identifier, fi.resourceid, f.transid, f.returned, f.transtime, f.loanuntil"  +
-               " FROM fulfillmentitem fi, fulfillment f, resourceitem ri" +
-               " WHERE ri.resourceid=fi.resourceid and fi.fulfillmentid=f.fulfillmentid and f.transid=%s")
+        sql = self.transaction_sql
 
-        self.connect()
+        self.connect('transaction_info')
         c = self.conn.cursor()
-        c.execute(sql, (transid, ))
-        row = self._fetchone_dict(c)
-        if row:
-            row['resourceid'] = 'urn:uuid:' + str(uuid.UUID(bytes=row['resourceid']))
-            row['loanuntil'] = row['loanuntil'].isoformat()
-            row['transtime'] = row['transtime'].isoformat()
-        return row
+        self._execute('transaction_info', c, sql, (transid, ))
+        # run _rows to the end, so the fetch is recorded in bssmetrics
+        rows = list(self._rows(c))
+        return rows[0] if rows else None
+
+def _drop_fields(rows, drop):
+    """ Returns rows as a list, without the 'drop' keys """
+    rows = list(rows)
+    if drop:
+        for r in rows:
+            for f in drop:
+                del r[f]
+    return rows
+
+def _match_expression(q, format=None):
+    """
+    An FTS5 MATCH expression for a search: every word of q, each as a
+    prefix, and with 'format', the words of it in the format column.
+    Raises ValueError if q has no words.
+    """
+    terms = re.findall(r'\w+', q, re.UNICODE)[:max_search_terms]
+    if not terms:
+        raise ValueError('nothing to search for')
+    expr = ' '.join('"%s"*' % t for t in terms)
+    format_terms = re.findall(r'\w+', format or '', re.UNICODE)[:max_search_terms]
+    if format_terms:
+        expr = '(%s) AND format : (%s)' % (expr, ' '.join('"%s"' % t for t in format_terms))
+    return expr
+
+class search_db:
+    """
+    Ranked search of the index bsssearch.py maintains.  Matches in
+    identifier count most, then title, creator and format.
+    """
+
+    search_sql = """
+            SELECT resourceid, identifier, title, creator, format
+                FROM resource_fts
+                WHERE resource_fts MATCH %s
+                ORDER BY bm25(resource_fts, 0, 10.0, 5.0, 3.0, 1.0)
+                LIMIT %s OFFSET %s
+        """
+
+    backend = None
+
+    def __init__(self):
+        if search_db.backend is None or search_db.backend.path != search_index:
+            search_db.backend = sqlite_backend(search_index)
+
+    def search(self, q, limit, cursor=None, format=None):
+        """
+        Returns up to 'limit' resources matching q, best first, and a
+        cursor for the next page (or None at the end), as a dict with
+        'resources' and 'next' keys.
+        """
+        offset = 0
+        if cursor:
+            offset, = _decode_cursor(cursor, 1)
+            offset = int(offset)
+            if offset < 0:
+                raise ValueError('bad cursor')
+        limit = max(0, min(limit, max_search_results - offset))
+        expr = _match_expression(q, format)
+
+        conn = self.backend.connection()
+        c = conn.cursor()
+        start = time.time()
+        self.backend.execute(c, self.search_sql, (expr, limit + 1, offset))
+        rows = c.fetchall()
+        bssmetrics.observe('bss_query_seconds', time.time() - start, (('query', 'search'), ))
+
+        names = ('resourceid', 'identifier', 'title', 'creator', 'format')
+        resources = [dict(zip(names, r)) for r in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit and offset + limit < max_search_results:
+            next_cursor = _encode_cursor([offset + limit])
+        return {'resources': resources, 'next': next_cursor}
+
+def _encode_cursor(values):
+    """ Pack a list of sort key values into an opaque, url-safe cursor """
+    s = json.dumps(values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor, length):
+    """ Unpack a cursor made by _encode_cursor, raising ValueError if it's bogus """
+    try:
+        s = base64.urlsafe_b64decode(str(cursor + '=' * (-len(cursor) % 4)))
+        values = json.loads(s.decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('bad cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError('bad cursor')
+    return values
+
+def _page_args():
+    """ Returns (limit, cursor) from the query string, limit None if not paging """
+    i = web.input(limit=None, cursor=None)
+    if i.limit is None:
+        return None, None
+    try:
+        limit = int(i.limit)
+    except ValueError:
+        raise web.badrequest()
+    if limit < 1 or limit > max_page_size:
+        raise web.badrequest()
+    return limit, i.cursor
+
+def _resource_columns(fields, required=()):
+    """
+    Returns (SELECT column list, columns to drop from the results) for
+    a fields tuple as made by _fields_arg (None for every column).
+    'required' columns are selected whether asked for or not, because
+    the query needs them; they're dropped again if they weren't asked
+    for.  Raises ValueError for unknown fields.
+    """
+    if fields is None:
+        return '*', ()
+    unknown = [f for f in fields if f not in resource_fields]
+    if unknown:
+        raise ValueError('unknown fields: ' + ', '.join(unknown))
+    columns = list(fields) + [f for f in required if f not in fields]
+    return ', '.join(columns), [f for f in required if f not in fields]
+
+def _project(sql, columns):
+    """ Replace the SELECT * of one of the resourceitem queries with columns """
+    return sql.replace('SELECT *', 'SELECT ' + columns, 1)
+
+def _fields_arg(default=None):
+    """
+    Returns the fields= argument as a tuple of resourceitem columns,
+    or None for all of them.  Takes a comma separated column list or
+    a profile name from resource_field_profiles.
+    """
+    fields = web.input(fields=None).fields
+    if not fields:
+        return default
+    if fields in resource_field_profiles:
+        return resource_field_profiles[fields]
+    fields = tuple(f.strip() for f in fields.split(',') if f.strip())
+    if not fields or [f for f in fields if f not in resource_fields]:
+        raise web.badrequest()
+    return fields
+
+def _cache_age(max_age, loanuntils=()):
+    """
+    Returns a Cache-Control max-age: max_age seconds, or less if one
+    of the given loanuntil times (isoformat, UTC) comes sooner.
+    """
+    now = datetime.datetime.utcnow()
+    for loanuntil in loanuntils:
+        if loanuntil:
+            t = datetime.datetime.strptime(loanuntil[:19], '%Y-%m-%dT%H:%M:%S')
+            if t > now:
+                max_age = min(max_age, int((t - now).total_seconds()) + 1)
+    return max_age
+
+def _utf8(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return s
+
+def _json_pretty(data):
+    return _utf8(json.dumps(data, sort_keys=True, indent=4))
+
+def _json_compact(data):
+    return _utf8(json.dumps(data, separators=(',', ':')))
+
+def _ndjson(data):
+    """
+    One compact JSON value per line: each entry of a list, or of the
+    list in a paged result followed by a {"next": cursor} line.
+    """
+    if isinstance(data, dict) and 'next' in data:
+        entries = [v for k, v in data.items() if k != 'next' and isinstance(v, list)]
+        if len(entries) == 1:
+            return _ndjson(entries[0]) + _json_compact({'next': data['next']}) + b'\n'
+    if not isinstance(data, list):
+        data = [data]
+    return b''.join(_json_compact(d) + b'\n' for d in data)
+
+def _msgpack(data):
+    return msgpack.packb(data, use_bin_type=True)
+
+def _raw_uuids(data):
+    """ Copy of data with urn:uuid resourceids turned back into 16 raw bytes """
+    if isinstance(data, list):
+        return [_raw_uuids(d) for d in data]
+    if isinstance(data, dict):
+        d = {}
+        for k, v in data.items():
+            if k in uuid_columns and v:
+                d[k] = uuid.UUID(v).bytes
+            else:
+                d[k] = _raw_uuids(v)
+        return d
+    return data
+
+# name -> (content type, serializer, whether it can carry raw bytes)
+serializers = {}
+
+# Accept header media type -> serializer name
+accept_types = {}
+
+def register_serializer(name, content_type, serialize, binary=False, media_types=()):
+    """
+    Make a response format available as ?format=name, and for the
+    given Accept media types.  serialize takes a handler result and
+    returns bytes.  Only binary formats get raw uuids (?uuids=raw).
+    """
+    serializers[name] = (content_type, serialize, binary)
+    for media_type in media_types:
+        accept_types[media_type] = name
+
+register_serializer('json', 'text/plain', _json_pretty)
+register_serializer('compact', 'application/json', _json_compact, media_types=['application/json'])
+register_serializer('ndjson', 'application/x-ndjson', _ndjson, media_types=['application/x-ndjson'])
+if msgpack is not None:
+    register_serializer('msgpack', 'application/x-msgpack', _msgpack, binary=True,
+                        media_types=['application/x-msgpack', 'application/msgpack'])
+
+def _output_format():
+    """ The serializer the client asked for, by ?format= or else Accept """
+    name = web.input(format=None).format
+    if name is None:
+        name = 'json'
+        for media_type in web.ctx.env.get('HTTP_ACCEPT', '').split(','):
+            media_type = media_type.split(';')[0].strip()
+            if media_type in accept_types:
+                name = accept_types[media_type]
+                break
+    if name not in serializers:
+        raise web.notacceptable()
+    return serializers[name]
+
+def _accepts_gzip(accept_encoding):
+    """
+    Whether an Accept-Encoding header allows gzip: gzip (or x-gzip)
+    listed with q > 0, or else * with q > 0.
+    """
+    q = {}
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if name == 'x-gzip':
+            name = 'gzip'
+        q[name] = weight
+    if 'gzip' in q:
+        return q['gzip'] > 0
+    return q.get('*', 0) > 0
+
+def _respond(data, max_age=None):
+    """
+    Serialize a handler result in the format the client asked for
+    (pretty-printed JSON by default), with a strong ETag made from
+    the content.  A matching If-None-Match gets a 304, clients that
+    accept gzip get it compressed, and max_age becomes Cache-Control.
+    """
+    content_type, serialize, binary = _output_format()
+    if binary and web.input(uuids=None).uuids == 'raw':
+        data = _raw_uuids(data)
+    body = serialize(data)
+    etag = hashlib.sha1(body).hexdigest()
+
+    gzipped = (len(body) >= gzip_min_size
+               and _accepts_gzip(web.ctx.env.get('HTTP_ACCEPT_ENCODING', '')))
+    # a different encoding is a different representation, so a different tag
+    etag = '"%s%s"' % (etag, '-gzip' if gzipped else '')
+
+    web.header("Content-Type", content_type)
+    web.header("ETag", etag)
+    web.header("Vary", 'Accept, Accept-Encoding')
+    if max_age is not None:
+        web.header("Cache-Control", 'max-age=%d' % max_age)
+
+    if_none_match = web.ctx.env.get('HTTP_IF_NONE_MATCH', '')
+    if if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]:
+        raise web.notmodified()
+
+    if gzipped:
+        buf = io.BytesIO()
+        # mtime=0 so identical content compresses identically
+        gz = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+        gz.write(body)
+        gz.close()
+        body = buf.getvalue()
+        web.header("Content-Encoding", 'gzip')
+    return body
 
 class is_loaned_out:
     def GET(self, resource):
-        web.header("Content-Type", 'text/plain')
         db = acs4db()
-        return json.dumps(db.get_loaned_out(resource), sort_keys=True, indent=4)
+        loans = db.get_loaned_out(resource)
+        return _respond(loans, _cache_age(loan_cache_age, [l['loanuntil'] for l in loans]))
 
 class fulfillment_info:
     def GET(self, resource):
-        web.header("Content-Type", 'text/plain')
         db = acs4db()
-        return json.dumps(db.get_fulfillment_info(resource), sort_keys=True, indent=4)
+        limit, cursor = _page_args()
+        if limit is not None and not resource:
+            try:
+                page = db.get_fulfillment_info_page(limit, cursor)
+            except (TypeError, ValueError):
+                raise web.badrequest()
+            return _respond(page, loan_cache_age)
+        return _respond(db.get_fulfillment_info(resource), loan_cache_age)
 
 class resource_info:
     def GET(self, resource):
-        web.header("Content-Type", 'text/plain')
         db = acs4db()
-        return json.dumps(db.get_resource_info(resource), sort_keys=True, indent=4)
+        limit, cursor = _page_args()
+        if limit is not None and not resource:
+            fields = _fields_arg(resource_field_profiles['lean'])
+            try:
+                page = db.get_resource_info_page(limit, cursor, fields)
+            except (TypeError, ValueError):
+                raise web.badrequest()
+            return _respond(page, resource_cache_age)
+        return _respond(db.get_resource_info(resource, _fields_arg()), resource_cache_age)
 
 class resource_info_by_id:
     def GET(self, identifier):
-        web.header("Content-Type", 'text/plain')
         db = acs4db()
-        return json.dumps(db.get_resource_info_by_id(identifier), sort_keys=True, indent=4)
+        resources = db.get_resource_info_by_id(identifier, _fields_arg())
+        return _respond(resources, _cache_age(loan_cache_age,
+                                              [r['loanstatus']['loanuntil'] for r in resources
+                                               if r['loanstatus']]))
 
 class transaction_info:
     def GET(self, transid):
-        web.header("Content-Type", 'text/plain')
         db = acs4db()
-        return json.dumps(db.get_transaction_info(transid), sort_keys=True, indent=4)
+        return _respond(db.get_transaction_info(transid), loan_cache_age)
+
+class availability:
+    def GET(self, identifiers):
+        identifiers = identifiers.split(',')
+        if len(identifiers) > max_availability_ids:
+            raise web.badrequest()
+        db = acs4db()
+        resources = db.get_availability(identifiers)
+        return _respond(resources, _cache_age(loan_cache_age, [r['next_free_at'] for r in resources]))
+
+class changes:
+    def GET(self, ignored):
+        i = web.input(cursor=None, wait='0', limit=str(max_page_size))
+        try:
+            wait = float(i.wait)
+            limit = int(i.limit)
+        except ValueError:
+            raise web.badrequest()
+        if math.isnan(wait) or math.isinf(wait):
+            raise web.badrequest()
+        wait = max(0, min(wait, max_change_wait))
+        if limit < 1 or limit > max_page_size:
+            raise web.badrequest()
+
+        db = acs4db()
+        deadline = time.time() + wait
+        while True:
+            try:
+                page = db.get_loan_changes(limit, i.cursor)
+            except (TypeError, ValueError):
+                raise web.badrequest()
+            if page['changes'] or not i.cursor or time.time() >= deadline:
+                break
+            # so the next poll sees events committed since this one
+            db.conn.rollback()
+            time.sleep(change_poll_interval)
+        return _respond(page, 0)
+
+class search:
+    def GET(self, ignored):
+        # format= picks the response encoding, so the format filter is media=
+        i = web.input(q='', media=None, limit='20', cursor=None)
+        try:
+            limit = int(i.limit)
+        except ValueError:
+            raise web.badrequest()
+        if limit < 1 or limit > max_page_size:
+            raise web.badrequest()
+        # connecting would create an empty index file
+        if not os.path.exists(search_index):
+            raise self.unavailable()
+        try:
+            results = search_db().search(i.q, limit, i.cursor, i.media)
+        except (TypeError, ValueError):
+            raise web.badrequest()
+        except sqlite3.OperationalError:
+            # not built yet, or locked
+            raise self.unavailable()
+        return _respond(results, resource_cache_age)
+
+    def unavailable(self):
+        return web.HTTPError('503 Service Unavailable', {'Content-Type': 'text/plain'},
+                             'search index unavailable')
+
+class loan_state:
+    def GET(self, resource):
+        db = acs4db()
+        states = db.get_loan_state(resource)
+        return _respond(states, _cache_age(loan_cache_age, [s['earliest_loanuntil'] for s in states]))
+
+class metrics:
+    def GET(self):
+        web.header("Content-Type", 'text/plain; version=0.0.4')
+        return bssmetrics.render()
 
 class item:
     def GET(self, identifier):
-        web.header("Content-Type", 'text/plain')
         db = acs4db()
         d = {
           "identifier": identifier,
-          "resources": [self.process_resource(db, x) for x in db.get_resource_info_by_id(identifier)]
+          "resources": [self.process_resource(db, x)
+                        for x in db.get_resource_info_by_id(identifier, ('resourceid', 'src', 'format'),
+                                                            loanstatus=False)]
         }
-        return json.dumps(d, sort_keys=True, indent=4)
+        return _respond(d, _cache_age(loan_cache_age,
+                                      [l['loanuntil'] for r in d['resources'] for l in r['loans']]))
 
     def process_resource(self, db, resource):
         d = {}
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Benchmarks for bss.py.
+
+Row decoding: runs a synthetic is_loaned_out result set through the
+old fetchone-per-row loops and through acs4db._rows(), without needing
+a database.  Each produces the same dicts (checked), so they do the
+same work.
+
+python bssbench.py --rows=1000000
+
+Startup: compares serving requests CGI-style (a fresh interpreter,
+imports and database connection per request) with the long-lived
+WSGI app in bsswsgi.py.
+
+python bssbench.py --startup --path=/is_loaned_out/ --requests=50
+
+"""
+from __future__ import print_function
+
+import datetime
+import optparse
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import bss
+
+
+class synthetic_cursor:
+    """ Just enough of a DB-API cursor to replay a canned result """
+    def __init__(self, description, rows):
+        self.description = description
+        self.rows = rows
+        self.pos = 0
+
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchmany(self, size):
+        batch = self.rows[self.pos:self.pos + size]
+        self.pos += len(batch)
+        return batch
+
+
+def loaned_out_rows(count):
+    """ rows shaped like the get_loaned_out query result """
+    if bss.MySQLdb is not None:
+        FIELD_TYPE = bss.MySQLdb.FIELD_TYPE
+        types = [FIELD_TYPE.STRING, FIELD_TYPE.STRING, FIELD_TYPE.DATETIME,
+                 FIELD_TYPE.DATETIME, FIELD_TYPE.DATETIME, FIELD_TYPE.VAR_STRING]
+    else:
+        types = [None] * 6
+    names = ['resourceid', 'returned', 'until', 'loanuntil', 'transtime', 'transid']
+    description = list(zip(names, types))
+    now = datetime.datetime(2010, 6, 26, 7, 35, 58)
+    rows = []
+    for i in range(count):
+        t = now + datetime.timedelta(seconds=i)
+        rows.append((os.urandom(16), 'F', t, t, now, 'trans-%d' % i))
+    return description, rows
+
+
+def fetchone_decode(c):
+    """ the per-row loop bss used before acs4db._rows """
+    resources = []
+    r = c.fetchone()
+    while r != None:
+        r_dict = {}
+        r_dict['resourceid'] = 'urn:uuid:' + str(uuid.UUID(bytes=r[0]))
+        r_dict['transtime'] = r[-2].isoformat()
+        r_dict['transid'] = r[-1]
+        r_dict['returned'] = r[1]
+        if r[2]:
+            r_dict['until'] = r[2].isoformat()
+        else:
+            r_dict['until'] = None
+        if r[3]:
+            r_dict['loanuntil'] = r[3].isoformat()
+        else:
+            r_dict['loanuntil'] = None
+        resources.append(r_dict)
+        r = c.fetchone()
+    return resources
+
+
+def fetchone_dict_decode(c):
+    """ the _fetchone_dict loop get_resource_info used, plus datetime conversion """
+    resources = []
+    while True:
+        r = c.fetchone()
+        if r == None:
+            break
+        d = {}
+        for i in range(len(r)):
+            d[c.description[i][0]] = r[i]
+        d['resourceid'] = 'urn:uuid:' + str(uuid.UUID(bytes=d['resourceid']))
+        for name in ('until', 'loanuntil', 'transtime'):
+            if d[name]:
+                d[name] = d[name].isoformat()
+        resources.append(d)
+    return resources
+
+
+def rows_decode(c):
+    return list(bss.acs4db()._rows(c))
+
+
+def wsgi_get(application, path):
+    """ Run one GET through a WSGI app, returning the status line """
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.0',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': sys.stdin,
+        'wsgi.errors': sys.stderr,
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        }
+    status = []
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+    for chunk in application(environ, start_response):
+        pass
+    return status[0]
+
+
+cgi_snippet = """
+import sys
+import bssbench, bsswsgi
+bssbench.wsgi_get(bsswsgi.application, sys.argv[1])
+"""
+
+
+def startup_bench(path, requests):
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    start = time.time()
+    for i in range(requests):
+        subprocess.check_call([sys.executable, '-c', cgi_snippet, path], cwd=here)
+    cgi = (time.time() - start) / requests
+
+    import bsswsgi
+    start = time.time()
+    for i in range(requests):
+        status = wsgi_get(bsswsgi.application, path)
+    wsgi = (time.time() - start) / requests
+
+    print('GET %s -> %s' % (path, status))
+    print('cgi   %8.2fms/request' % (cgi * 1000))
+    print('wsgi  %8.2fms/request' % (wsgi * 1000))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--rows',
+                      action='store',
+                      type='int',
+                      default=1000000,
+                      help='Rows in the synthetic result (default 1000000)')
+    parser.add_option('--repeat',
+                      action='store',
+                      type='int',
+                      default=3,
+                      help='Decode this many times and report the fastest (default 3)')
+    parser.add_option('--startup',
+                      action='store_true',
+                      help='Compare CGI and WSGI per-request cost instead')
+    parser.add_option('--path',
+                      action='store',
+                      default='/is_loaned_out/',
+                      help='bss path to request for --startup')
+    parser.add_option('--requests',
+                      action='store',
+                      type='int',
+                      default=50,
+                      help='Requests to time for --startup (default 50)')
+    opts, args = parser.parse_args(argv)
+
+    if opts.startup:
+        startup_bench(opts.path, opts.requests)
+        return
+
+    description, rows = loaned_out_rows(opts.rows)
+    reference = None
+    for name, decode in [('fetchone', fetchone_decode),
+                         ('fetchone_dict', fetchone_dict_decode),
+                         ('_rows', rows_decode)]:
+        elapsed = None
+        for i in range(max(1, opts.repeat)):
+            c = synthetic_cursor(description, rows)
+            start = time.time()
+            result = decode(c)
+            t = time.time() - start
+            elapsed = t if elapsed is None else min(elapsed, t)
+        if reference is None:
+            reference = result
+        assert result == reference, name
+        print('%-14s %8.3fs  %10.0f rows/s' % (name, elapsed, len(rows) / elapsed))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Export fulfillment history from the adept database as date-partitioned
+columnar files, for analytics:
+
+python bssexport.py /data/loans            # everything new since the last run
+python bssexport.py /data/loans --format=csv
+
+Each run reads fulfillment items joined with their resource's
+identifier, title and format, in batches, and writes
+
+/data/loans/date=2010-06-26/part-20100627T000500.parquet   (or .csv.gz)
+
+one file per transtime day per run.  Parquet needs pyarrow; without
+it, or with --format=csv, files are gzipped csv.
+
+/data/loans/_watermark.json records the newest transtime exported, and
+the next run starts after it.  Rows newer than --settle seconds ago are
+left for the next run, so fulfillments committed a little after their
+transtime aren't skipped.  A row's returned flag is as it was when it
+was exported; later returns aren't re-exported.
+
+"""
+from __future__ import print_function
+
+import binascii
+import csv
+import datetime
+import gzip
+import io
+import json
+import optparse
+import os
+import sys
+import time
+import uuid
+
+import bss
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+columns = ['transtime', 'transid', 'fulfillmentid', 'resourceid', 'loanuntil', 'until',
+           'returnable', 'returned', 'identifier', 'title', 'format']
+timestamp_columns = ('transtime', 'loanuntil', 'until')
+
+batch_size = 10000
+
+watermark_file = '_watermark.json'
+epoch = '1970-01-01 00:00:00'
+
+
+class csv_part(object):
+    extension = '.csv.gz'
+
+    def __init__(self, path):
+        self.f = gzip.open(path, 'wb')
+        if sys.version_info[0] >= 3:
+            self.text = io.TextIOWrapper(self.f, encoding='utf-8', newline='')
+        else:
+            self.text = self.f
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows([r[c] for c in columns] for r in rows)
+
+    def close(self):
+        self.text.close()
+
+
+class parquet_part(object):
+    extension = '.parquet'
+
+    def __init__(self, path):
+        fields = [pyarrow.field(c, pyarrow.timestamp('s') if c in timestamp_columns else pyarrow.string())
+                  for c in columns]
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='snappy')
+
+    def write(self, rows):
+        arrays = []
+        for field in self.schema:
+            values = [r[field.name] for r in rows]
+            if field.name in timestamp_columns:
+                values = [_parse_time(v) for v in values]
+            arrays.append(pyarrow.array(values, field.type))
+        # each batch becomes a row group
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def _parse_time(s):
+    if s is None:
+        return None
+    return datetime.datetime.strptime(s[:19].replace('T', ' '), '%Y-%m-%d %H:%M:%S')
+
+
+def _db_time(s):
+    """ An isoformat time from bss rows as the database compares it """
+    return s[:19].replace('T', ' ')
+
+
+def read_watermark(outdir):
+    path = os.path.join(outdir, watermark_file)
+    if not os.path.exists(path):
+        return epoch
+    with open(path) as f:
+        return json.load(f)['transtime']
+
+
+def write_watermark(outdir, transtime, rows):
+    path = os.path.join(outdir, watermark_file)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'transtime': transtime, 'rows': rows,
+                   'exported': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}, f)
+    os.rename(path + '.tmp', path)
+
+
+def db_now(db):
+    db.connect()
+    c = db.conn.cursor()
+    db.backend.execute(c, "SELECT NOW()")
+    now = c.fetchone()[0]
+    if not isinstance(now, datetime.datetime):
+        now = _parse_time(str(now))
+    return now
+
+
+def export(db, outdir, part_class, settle=300):
+    """
+    Export rows newer than the watermark into outdir.  Returns (rows
+    exported, new watermark).  Files are written under temporary names
+    and only renamed, and the watermark moved, once all are complete.
+    """
+    since = read_watermark(outdir)
+    until = (db_now(db) - datetime.timedelta(seconds=settle)).strftime('%Y-%m-%d %H:%M:%S')
+    if until <= since:
+        return 0, since
+
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+    finished = []
+    part = day = None
+    count = 0
+    after = None
+    try:
+        while True:
+            rows = db.get_fulfillment_history(since, until, batch_size, after)
+            if not rows:
+                break
+            last = rows[-1]
+            after = (_db_time(last['transtime']), last['fulfillmentid'], uuid.UUID(last['resourceid']).bytes)
+            for r in rows:
+                r['fulfillmentid'] = binascii.hexlify(r['fulfillmentid']).decode('ascii')
+
+            # rows come in transtime order, so each day's file is written
+            # in one go; a batch can span a day boundary
+            start = 0
+            while start < len(rows):
+                row_day = rows[start]['transtime'][:10]
+                end = start
+                while end < len(rows) and rows[end]['transtime'][:10] == row_day:
+                    end += 1
+                if row_day != day:
+                    if part is not None:
+                        part.close()
+                    day = row_day
+                    partdir = os.path.join(outdir, 'date=' + day)
+                    if not os.path.isdir(partdir):
+                        os.makedirs(partdir)
+                    path = os.path.join(partdir, 'part-' + stamp + part_class.extension)
+                    part = part_class(path + '.tmp')
+                    finished.append(path)
+                part.write(rows[start:end])
+                start = end
+            count += len(rows)
+        if part is not None:
+            part.close()
+            part = None
+    except Exception:
+        if part is not None:
+            part.close()
+        for path in finished:
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+        raise
+
+    for path in finished:
+        os.rename(path + '.tmp', path)
+    write_watermark(outdir, until, count)
+    return count, until
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options] OUTPUT_DIR',
+                                   description='Export new fulfillment history as columnar files.')
+    parser.add_option('--format',
+                      action='store',
+                      choices=['parquet', 'csv'],
+                      help='parquet (needs pyarrow) or csv (gzipped); default parquet if available')
+    parser.add_option('--settle',
+                      action='store',
+                      type='int',
+                      default=300,
+                      help='Leave rows newer than this many seconds for the next run (default 300)')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('Please supply the output directory')
+
+    fmt = opts.format or ('parquet' if pyarrow is not None else 'csv')
+    if fmt == 'parquet' and pyarrow is None:
+        parser.error('parquet output needs pyarrow; use --format=csv')
+    outdir = args[0]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    db = bss.acs4db()
+    start = time.time()
+    count, watermark = export(db, outdir, parquet_part if fmt == 'parquet' else csv_part, opts.settle)
+    db.close()
+    print('%d rows to %s in %.1fs, up to %s' % (count, outdir, time.time() - start, watermark))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
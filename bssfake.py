@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Fill an sqlite database with synthetic adept data, for running and
+load-testing bss.py offline:
+
+python bssfake.py /tmp/adept.db --resources=100000 --loans=2000000
+BSS_DB=sqlite:/tmp/adept.db python bss.py 8080
+
+Resources come in epub and pdf pairs sharing an identifier, each
+distributed for loan with 1-3 copies.  Loans
+are spread over the last --years years, run --loan_days days, and
+most past loans are marked returned; some are still out, and a few
+fulfillments are purchases with no loanuntil at all.
+
+The loan-state tables are then filled by a bssloanstate.py pass, so
+/loan_state/, /changes/ and bss.use_loan_state work too; run
+BSS_DB=sqlite:/tmp/adept.db python bssloanstate.py to keep them fresh.
+
+"""
+from __future__ import print_function
+
+import datetime
+import optparse
+import random
+import sys
+import uuid
+
+import bss
+import bssloanstate
+
+batch_size = 10000
+
+formats = [('application/epub+zip', 'epub'), ('application/pdf', 'pdf')]
+words = ('the of and a in to history life world new art war love book man time'
+         ' story city house night water day light music river guide garden'.split())
+
+
+def random_bytes(rng, n):
+    return bytes(bytearray(rng.getrandbits(8) for i in range(n)))
+
+
+def resources(rng, count):
+    """ Generates resourceitem rows """
+    n = 0
+    for i in range(count):
+        identifier = 'book%08d' % i
+        title = ' '.join(rng.choice(words) for w in range(rng.randint(2, 6))).title()
+        creator = '%s %s' % (rng.choice(words).title(), rng.choice(words).title())
+        for mimetype, ext in formats:
+            if n >= count:
+                return
+            n += 1
+            yield (uuid.UUID(int=rng.getrandbits(128)).bytes, 1, identifier, title, creator,
+                   'Internet Archive', 'en', mimetype,
+                   'http://archive.org/download/%s/%s.%s' % (identifier, identifier, ext),
+                   rng.randint(100000, 20000000))
+
+
+def fulfillments(rng, resourceids, count, years, loan_days, now):
+    """ Generates (fulfillment row, fulfillmentitem row) pairs """
+    distid = uuid.UUID(int=1).bytes
+    span = int(years * 365 * 86400)
+    loan = datetime.timedelta(days=loan_days)
+    for i in range(count):
+        transtime = now - datetime.timedelta(seconds=rng.randint(0, span))
+        fulfillmentid = random_bytes(rng, 20)
+        if rng.random() < 0.05:
+            # a purchase: no loan period
+            loanuntil = until = returned = returnable = None
+        else:
+            loanuntil = until = transtime + loan
+            returnable = 'T'
+            if loanuntil < now:
+                returned = 'T' if rng.random() < 0.7 else 'F'
+            else:
+                returned = 'T' if rng.random() < 0.2 else 'F'
+        yield ((fulfillmentid, distid, uuid.UUID(int=rng.getrandbits(128)).urn, transtime,
+                random_bytes(rng, 20), loanuntil, random_bytes(rng, 16), 'T', returnable, returned),
+               (fulfillmentid, rng.choice(resourceids), until, None))
+
+
+def batches(rows):
+    rows = iter(rows)
+    while True:
+        batch = [r for i, r in zip(range(batch_size), rows)]
+        if not batch:
+            return
+        yield batch
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options] SQLITE_FILE')
+    parser.add_option('--resources',
+                      action='store',
+                      type='int',
+                      default=10000,
+                      help='resourceitem rows (default 10000)')
+    parser.add_option('--loans',
+                      action='store',
+                      type='int',
+                      default=100000,
+                      help='fulfillment rows (default 100000)')
+    parser.add_option('--years',
+                      action='store',
+                      type='float',
+                      default=3,
+                      help='years of loan history (default 3)')
+    parser.add_option('--loan_days',
+                      action='store',
+                      type='int',
+                      default=14,
+                      help='loan period in days (default 14)')
+    parser.add_option('--seed',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='random seed (default 0)')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('Please supply the sqlite file to fill')
+
+    rng = random.Random(opts.seed)
+    backend = bss.sqlite_backend(args[0])
+    backend.create_tables()
+    conn = backend.connection()
+
+    resourceids = []
+    for batch in batches(resources(rng, opts.resources)):
+        conn.executemany('INSERT INTO resourceitem (resourceid, item, identifier, title, creator,'
+                         ' publisher, language, format, src, size)'
+                         ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+        resourceids.extend(r[0] for r in batch)
+    print('%d resources' % len(resourceids))
+
+    distid = uuid.UUID(int=1).bytes
+    for batch in batches(resourceids):
+        conn.executemany('INSERT INTO distributionrights (distid, resourceid, distributiontype,'
+                         ' available, returnable) VALUES (?, ?, ?, ?, ?)',
+                         [(distid, r, 'loan', rng.randint(1, 3), 'T') for r in batch])
+
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    n = 0
+    for batch in batches(fulfillments(rng, resourceids, opts.loans, opts.years, opts.loan_days, now)):
+        conn.executemany('INSERT INTO fulfillment VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [f for f, fi in batch])
+        conn.executemany('INSERT INTO fulfillmentitem VALUES (?, ?, ?, ?)',
+                         [fi for f, fi in batch])
+        n += len(batch)
+    print('%d fulfillments' % n)
+
+    conn.commit()
+
+    db = bss.acs4db(backend)
+    db.connect()
+    started, ended = bssloanstate.refresh(db)
+    print('%d active loans' % len(started))
+    backend.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
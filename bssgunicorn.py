@@ -0,0 +1,34 @@
+"""
+gunicorn settings for bss.py:
+
+gunicorn -c bssgunicorn.py bsswsgi:application
+
+Deploy new code gracefully (new workers start before the old ones
+finish their requests) with:
+
+kill -HUP $(cat /var/run/bss.pid)
+
+"""
+import multiprocessing
+
+bind = '127.0.0.1:8081'
+pidfile = '/var/run/bss.pid'
+workers = multiprocessing.cpu_count() + 1
+worker_class = 'gthread'
+threads = 4
+graceful_timeout = 30
+
+# Each worker imports the app itself, so a HUP's new workers pick up
+# new code; with preload_app they'd be forked from the master's copy
+# of the old code.  Database connections are opened per worker thread.
+preload_app = False
+
+
+def post_fork(server, worker):
+    import bsswsgi
+    bsswsgi.init_worker()
+
+
+def worker_exit(server, worker):
+    import bsswsgi
+    bsswsgi.close_worker()
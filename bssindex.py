@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Index advisor for the adept database behind bss.py.
+
+Compares the live schema with the indexes the bss queries want, runs
+EXPLAIN on each bss query, reports full table scans and filesorts,
+and prints (or with --apply, runs) the CREATE INDEX statements for
+whatever is missing.  The queries are recorded from bss.acs4db's own
+methods, so they're always the ones bss runs.
+
+python bssindex.py
+python bssindex.py --apply
+
+"""
+from __future__ import print_function
+
+import binascii
+import optparse
+import sys
+import uuid
+
+import bss
+
+# (table, index name, columns) - what the bss queries filter, join
+# and sort on.  An existing index whose leading columns match counts.
+wanted_indexes = [
+    ('fulfillmentitem', 'bss_fi_resourceid', ['resourceid', 'fulfillmentid', 'until']),
+    ('fulfillmentitem', 'bss_fi_fulfillmentid', ['fulfillmentid']),
+    ('fulfillment', 'bss_f_transid', ['transid']),
+    ('fulfillment', 'bss_f_loanuntil', ['loanuntil', 'returned']),
+    ('fulfillment', 'bss_f_transtime', ['transtime']),
+    ('resourceitem', 'bss_ri_identifier', ['identifier', 'format']),
+    ('resourceitem', 'bss_ri_title', ['title', 'resourceid']),
+    ('distributionrights', 'bss_dr_resourceid', ['resourceid']),
+]
+
+# prefix length used when indexing text / blob columns
+text_prefix = 255
+
+sample_uuid = b'\0' * 16
+
+
+class _no_connection(object):
+    def cursor(self):
+        return None
+
+
+class sql_recorder(bss.acs4db):
+    """
+    An acs4db whose methods record the SQL they would run, with its
+    args, instead of running it - so the queries EXPLAINed are the
+    ones bss.py builds, however its SQL changes.
+    """
+
+    def __init__(self):
+        bss.acs4db.__init__(self)
+        self.statements = []
+
+    def connect(self, query=None):
+        self.conn = _no_connection()
+
+    def _execute(self, query, cursor, sql, args=None):
+        self.statements.append((sql, tuple(args or ())))
+
+    def _rows(self, cursor):
+        return iter([])
+
+
+def _active_loans(db, resource=None):
+    """ get_loaned_out as it runs while bssloanstate.py keeps the loan state fresh """
+    db.loaned_out_sql = db.active_loan_sql
+    return db.get_loaned_out(resource)
+
+
+def bss_queries():
+    """ Returns (name, sql, args) for each query shape bss runs """
+    resource = str(uuid.UUID(bytes=sample_uuid))
+    zeros = binascii.hexlify(sample_uuid).decode('ascii')
+
+    def fulfillment_cursor(loanuntil):
+        return bss._encode_cursor([loanuntil, '00' * 20, zeros])
+
+    def resource_cursor(title):
+        return bss._encode_cursor([title, zeros])
+
+    since, until = '1970-01-01 00:00:00', '1970-01-02 00:00:00'
+    calls = [
+        ('fulfillment_info', lambda db: db.get_fulfillment_info()),
+        ('fulfillment_info/resource', lambda db: db.get_fulfillment_info(resource)),
+        ('fulfillment_info/page', lambda db: db.get_fulfillment_info_page(100)),
+        ('fulfillment_info/page+', lambda db: db.get_fulfillment_info_page(100, fulfillment_cursor(since))),
+        ('fulfillment_info/page+null', lambda db: db.get_fulfillment_info_page(100, fulfillment_cursor(None))),
+        ('is_loaned_out', lambda db: db.get_loaned_out()),
+        ('is_loaned_out/resource', lambda db: db.get_loaned_out(resource)),
+        ('is_loaned_out/active', _active_loans),
+        ('is_loaned_out/active/resource', lambda db: _active_loans(db, resource)),
+        ('resource_info', lambda db: db.get_resource_info()),
+        ('resource_info/resource', lambda db: db.get_resource_info(resource)),
+        ('resource_info/page', lambda db: db.get_resource_info_page(100)),
+        ('resource_info/page+', lambda db: db.get_resource_info_page(100, resource_cursor(''))),
+        ('resource_info/page+null', lambda db: db.get_resource_info_page(100, resource_cursor(None))),
+        ('resource_info_by_id', lambda db: db.get_resource_info_by_id('x', loanstatus=False)),
+        ('transaction_info', lambda db: db.get_transaction_info('')),
+        ('availability', lambda db: db.get_availability(['x'])),
+        ('loan_state', lambda db: db.get_loan_state()),
+        ('loan_state/resource', lambda db: db.get_loan_state(resource)),
+        ('changes', lambda db: db.get_loan_changes(100, bss._encode_cursor([0]))),
+        ('fulfillment_history', lambda db: db.get_fulfillment_history(since, until, 10000)),
+        ('fulfillment_history+', lambda db: db.get_fulfillment_history(since, until, 10000,
+                                                                        (since, b'\0' * 20, sample_uuid))),
+    ]
+    queries = []
+    for name, call in calls:
+        db = sql_recorder()
+        call(db)
+        for sql, args in db.statements:
+            queries.append((name, sql, args))
+    return queries
+
+
+def existing_indexes(c, table):
+    """ Returns {index name: [columns in order]} for a table """
+    c.execute("SHOW INDEX FROM " + table)
+    names = [d[0] for d in c.description]
+    indexes = {}
+    for row in c.fetchall():
+        r = dict(zip(names, row))
+        cols = indexes.setdefault(r['Key_name'], [])
+        cols.append((r['Seq_in_index'], r['Column_name']))
+    return dict((k, [col for seq, col in sorted(v)]) for k, v in indexes.items())
+
+
+def column_types(c, table):
+    c.execute("SELECT column_name, data_type FROM information_schema.columns"
+              " WHERE table_schema = DATABASE() AND table_name = %s", (table, ))
+    return dict((name.lower(), data_type.lower()) for name, data_type in c.fetchall())
+
+
+def missing_indexes(c):
+    """ Returns the CREATE INDEX statements for wanted indexes not covered by the schema """
+    ddl = []
+    for table, name, columns in wanted_indexes:
+        have = existing_indexes(c, table).values()
+        if any(cols[:len(columns)] == columns for cols in have):
+            continue
+        types = column_types(c, table)
+        parts = []
+        for col in columns:
+            if types.get(col, '').endswith(('text', 'blob')):
+                parts.append('%s(%d)' % (col, text_prefix))
+            else:
+                parts.append(col)
+        ddl.append('CREATE INDEX %s ON %s (%s)' % (name, table, ', '.join(parts)))
+    return ddl
+
+
+def explain(c, sql, args):
+    """ Returns a list of problems EXPLAIN reports for a query """
+    c.execute("EXPLAIN " + sql, args)
+    names = [d[0].lower() for d in c.description]
+    problems = []
+    for row in c.fetchall():
+        r = dict(zip(names, row))
+        extra = r.get('extra') or ''
+        if r.get('type') == 'ALL':
+            problems.append('full scan of %s (~%s rows)' % (r.get('table'), r.get('rows')))
+        if 'Using filesort' in extra:
+            problems.append('filesort on %s' % r.get('table'))
+        if 'Using temporary' in extra:
+            problems.append('temporary table on %s' % r.get('table'))
+    return problems
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Check the adept database indexes used by bss.py.')
+    parser.add_option('--apply',
+                      action='store_true',
+                      help='Create the missing indexes (locks tables while building!)')
+    opts, args = parser.parse_args(argv)
+
+    db = bss.acs4db()
+    db.connect()
+    c = db.conn.cursor()
+
+    print('EXPLAIN:')
+    for name, sql, qargs in bss_queries():
+        try:
+            problems = explain(c, sql, qargs)
+        except db.backend.Error as e:
+            # e.g. the loan-state tables before bssloanstate.py --create
+            problems = ['EXPLAIN failed: %s' % e]
+        print('  %-28s %s' % (name, '; '.join(problems) if problems else 'ok'))
+
+    ddl = missing_indexes(c)
+    print()
+    if not ddl:
+        print('All wanted indexes are present.')
+    for stmt in ddl:
+        print(stmt + ';')
+        if opts.apply:
+            c.execute(stmt)
+    db.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Background refresher for the bss loan-state tables.
+
+Keeps two small tables in the adept database up to date, so bss can
+answer loan questions without re-checking the active-loan predicate
+over the whole fulfillment history:
+
+bss_activeloan - one row per currently active fulfillment item
+bss_loanstate  - per resource: active loan count, earliest and latest
+                 loanuntil, and the newest active loan's transid
+bss_loanevent  - a log of loans starting, being returned and expiring,
+                 read by bss's /changes/ feed
+
+Each pass picks up fulfillments newer than a transtime watermark, then
+sweeps the active set for loans that have expired or been returned.
+
+python bssloanstate.py --create     # once, to make the tables
+python bssloanstate.py              # refresh every --interval seconds
+
+Then set bss.use_loan_state = True.  With BSS_DB=sqlite:PATH it keeps
+the tables of a bssfake.py database instead; times are then
+compared as the text sqlite stores them in.
+
+"""
+from __future__ import print_function
+
+import datetime
+import optparse
+import sys
+import time
+
+import bss
+
+watermark_name = 'loanstate'
+
+# Fulfillments can commit a little after their transtime; re-read this
+# many seconds behind the watermark so they aren't missed.
+overlap_secs = 60
+
+# how long to keep bss_loanevent rows
+event_keep_days = 30
+
+# The SQL here runs on MySQL and, through bss.sqlite_backend, on
+# sqlite: times are passed in rather than worked out with INTERVAL.
+event_sql = """
+    INSERT INTO bss_loanevent (event, resourceid, transid, eventtime, recorded)
+        VALUES (%s, %s, %s, %s, %s)
+"""
+
+create_sql = [
+    """
+    CREATE TABLE IF NOT EXISTS bss_activeloan (
+        fulfillmentid binary(20) NOT NULL,
+        resourceid binary(16) NOT NULL,
+        transid varchar(127) NOT NULL,
+        transtime datetime NOT NULL,
+        until datetime,
+        loanuntil datetime,
+        returned char(1),
+        PRIMARY KEY (fulfillmentid, resourceid),
+        KEY (resourceid)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS bss_loanstate (
+        resourceid binary(16) NOT NULL,
+        active_loans int NOT NULL,
+        earliest_loanuntil datetime,
+        latest_loanuntil datetime,
+        last_transid varchar(127),
+        last_transtime datetime,
+        PRIMARY KEY (resourceid)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS bss_loanevent (
+        id bigint NOT NULL AUTO_INCREMENT,
+        event varchar(16) NOT NULL,
+        resourceid binary(16) NOT NULL,
+        transid varchar(127) NOT NULL,
+        eventtime datetime NOT NULL,
+        recorded datetime NOT NULL,
+        PRIMARY KEY (id),
+        KEY (recorded)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS bss_watermark (
+        name varchar(32) NOT NULL,
+        value datetime NOT NULL,
+        refreshed datetime NOT NULL,
+        PRIMARY KEY (name)
+    )
+    """,
+]
+
+new_loans_sql = """
+    SELECT f.fulfillmentid, fi.resourceid, f.transid, f.transtime, fi.until, f.loanuntil, f.returned
+        FROM fulfillment f, fulfillmentitem fi
+        WHERE fi.fulfillmentid = f.fulfillmentid
+            AND f.transtime >= %s
+            AND (
+                    (
+                        (f.loanuntil IS NULL OR fi.until IS NULL)
+                        OR
+                        (f.loanuntil > %s)
+                    )
+                    AND
+                    ( f.returned IS NULL OR f.returned = 'F')
+                )
+"""
+
+ended_loans_sql = """
+    SELECT a.fulfillmentid, a.resourceid, a.transid,
+            CASE WHEN f.returned IS NULL OR f.returned = 'F' THEN 'expired' ELSE 'returned' END,
+            a.loanuntil
+        FROM bss_activeloan a, fulfillment f
+        WHERE f.fulfillmentid = a.fulfillmentid
+            AND (
+                    (a.loanuntil IS NOT NULL AND a.until IS NOT NULL AND a.loanuntil <= %s)
+                    OR
+                    (f.returned IS NOT NULL AND f.returned != 'F')
+                )
+"""
+
+summary_sql = """
+    SELECT COUNT(*), MIN(loanuntil), MAX(loanuntil), MAX(transtime)
+        FROM bss_activeloan WHERE resourceid = %s
+"""
+
+last_transid_sql = """
+    SELECT transid FROM bss_activeloan WHERE resourceid = %s ORDER BY transtime DESC LIMIT 1
+"""
+
+save_summary_sql = """
+    REPLACE INTO bss_loanstate
+            (resourceid, active_loans, earliest_loanuntil, latest_loanuntil, last_transid, last_transtime)
+        VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+
+def create_tables(c):
+    for sql in create_sql:
+        c.execute(sql)
+
+
+def _datetime(v):
+    """ sqlite hands back computed times as text """
+    if v is None or isinstance(v, datetime.datetime):
+        return v
+    return datetime.datetime.strptime(str(v)[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def summarize(db, c, resourceid):
+    """
+    Rewrite a resource's bss_loanstate row from its active loans.  With
+    none left, the last loan's transid and transtime are kept.
+    """
+    db.backend.execute(c, summary_sql, (resourceid, ))
+    count, earliest, latest, last_transtime = c.fetchone()
+    if count:
+        db.backend.execute(c, last_transid_sql, (resourceid, ))
+        last_transid = c.fetchone()[0]
+    else:
+        db.backend.execute(c, "SELECT last_transid, last_transtime FROM bss_loanstate WHERE resourceid = %s",
+                           (resourceid, ))
+        last_transid, last_transtime = c.fetchone() or (None, None)
+    db.backend.execute(c, save_summary_sql, (resourceid, count, _datetime(earliest), _datetime(latest),
+                                             last_transid, _datetime(last_transtime)))
+
+
+def refresh(db):
+    """
+    One refresh pass.  Returns (started, ended): the fulfillment item
+    rows that became active, and (fulfillmentid, resourceid, transid,
+    reason, loanuntil) for those that stopped being active, reason
+    being 'expired' or 'returned'.  Each is also logged to
+    bss_loanevent.
+    """
+    c = db.conn.cursor()
+    execute = db.backend.execute
+    # bss connections autocommit; make the pass one transaction
+    execute(c, "BEGIN")
+
+    execute(c, "SELECT NOW()")
+    now = _datetime(c.fetchone()[0])
+
+    execute(c, "SELECT value FROM bss_watermark WHERE name = %s", (watermark_name, ))
+    row = c.fetchone()
+    watermark = _datetime(row[0]) if row else datetime.datetime(1970, 1, 1)
+
+    execute(c, "SELECT MAX(transtime) FROM fulfillment WHERE transtime >= %s", (watermark, ))
+    newest = _datetime(c.fetchone()[0]) or watermark
+
+    execute(c, new_loans_sql, (watermark - datetime.timedelta(seconds=overlap_secs), now))
+    candidates = c.fetchall()
+    started = []
+    for r in candidates:
+        # rows already present are from the overlap window
+        execute(c, "INSERT IGNORE INTO bss_activeloan"
+                   " (fulfillmentid, resourceid, transid, transtime, until, loanuntil, returned)"
+                   " VALUES (%s, %s, %s, %s, %s, %s, %s)", r)
+        if c.rowcount > 0:
+            started.append(r)
+            execute(c, event_sql, ('loan', r[1], r[2], r[3], now))
+
+    execute(c, ended_loans_sql, (now, ))
+    ended = c.fetchall()
+    for fulfillmentid, resourceid, transid, reason, loanuntil in ended:
+        execute(c, "DELETE FROM bss_activeloan WHERE fulfillmentid = %s AND resourceid = %s",
+                (fulfillmentid, resourceid))
+        # there's no record of when a loan was returned; use when we noticed
+        execute(c, event_sql, (reason, resourceid, transid,
+                               loanuntil if reason == 'expired' else now, now))
+
+    touched = set(r[1] for r in started) | set(r[1] for r in ended)
+    for resourceid in touched:
+        summarize(db, c, resourceid)
+
+    execute(c, "DELETE FROM bss_loanevent WHERE recorded < %s",
+            (now - datetime.timedelta(days=event_keep_days), ))
+    execute(c, "REPLACE INTO bss_watermark (name, value, refreshed) VALUES (%s, %s, %s)",
+            (watermark_name, newest, now))
+    db.conn.commit()
+    return started, ended
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Keep the bss loan-state tables up to date.')
+    parser.add_option('--create',
+                      action='store_true',
+                      help='Create the loan-state tables and exit')
+    parser.add_option('--once',
+                      action='store_true',
+                      help='Run a single refresh pass and exit')
+    parser.add_option('--interval',
+                      action='store',
+                      type='float',
+                      default=5,
+                      help='Seconds between refresh passes (default 5)')
+    parser.add_option('-d', '--debug',
+                      action='store_true',
+                      help='Print what each pass changed')
+    opts, args = parser.parse_args(argv)
+
+    db = bss.acs4db()
+    db.connect()
+    if opts.create:
+        if isinstance(db.backend, bss.sqlite_backend):
+            db.backend.create_tables()
+        else:
+            create_tables(db.conn.cursor())
+            db.conn.commit()
+        return
+
+    while True:
+        db.connect()
+        started, ended = refresh(db)
+        if opts.debug:
+            print('%d new loans, %d ended' % (len(started), len(ended)))
+        if opts.once:
+            break
+        time.sleep(opts.interval)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,127 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+In-process counters and histograms for bss.py, rendered in the
+Prometheus text format by its /metrics endpoint.
+
+Metrics live in the serving process, so they're only useful when bss
+runs long-lived (bsswsgi.py); each worker process reports its own.
+
+"""
+import threading
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+row_buckets = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+_lock = threading.Lock()
+
+# name -> (type, help text)
+_described = {}
+
+# (name, labels) -> value, for counters and gauges
+_counters = {}
+
+# (name, labels) -> [buckets, per-bucket counts, sum, count], for histograms
+_histograms = {}
+
+
+def describe(name, kind, help):
+    """ Register a metric's type ('counter' or 'histogram') and help text """
+    _described[name] = (kind, help)
+
+
+def inc(name, labels=(), amount=1):
+    """ Add to a counter.  labels is a tuple of (label, value) pairs. """
+    key = (name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def gauge(name, value, labels=()):
+    """ Set a gauge """
+    with _lock:
+        _counters[(name, labels)] = value
+
+
+def observe(name, value, labels=(), buckets=latency_buckets):
+    """ Record a value in a histogram """
+    key = (name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [buckets, [0] * len(buckets), 0, 0]
+        for i, bound in enumerate(h[0]):
+            if value <= bound:
+                h[1][i] += 1
+                break
+        h[2] += value
+        h[3] += 1
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+def _format_bound(b):
+    return repr(float(b)) if isinstance(b, float) else str(b)
+
+
+def render():
+    """ Returns all metrics in the Prometheus text exposition format """
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, [v[0], list(v[1]), v[2], v[3]]) for k, v in _histograms.items())
+
+    lines = []
+    seen = set()
+    def header(name, default_kind):
+        if name in seen:
+            return
+        seen.add(name)
+        kind, help = _described.get(name, (default_kind, ''))
+        if help:
+            lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    for (name, labels), value in counters:
+        header(name, 'counter')
+        lines.append('%s%s %s' % (name, _format_labels(labels), value))
+
+    for (name, labels), (buckets, counts, total, count) in histograms:
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', _format_bound(bound))]),
+                                             cumulative))
+        lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', '+Inf')]), count))
+        lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(float(total))))
+        lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+
+    return '\n'.join(lines) + '\n'
+
+
+describe('bss_requests_total', 'counter', 'Requests served, by handler and HTTP status.')
+describe('bss_request_seconds', 'histogram', 'Time to serve a request, by handler.')
+describe('bss_response_bytes', 'histogram', 'Response body size, by handler.')
+describe('bss_query_seconds', 'histogram', 'SQL execute time, by acs4db query.')
+describe('bss_fetch_seconds', 'histogram', 'Time fetching and decoding result rows, by acs4db query.')
+describe('bss_query_rows', 'histogram', 'Rows returned, by acs4db query.')
+describe('bss_db_connects_total', 'counter', 'New database connections made.')
+describe('bss_db_connect_retries_total', 'counter', 'Failed connect attempts that were retried.')
+describe('bss_db_connect_failures_total', 'counter', 'Connects that failed after all retries.')
+describe('bss_db_reconnects_total', 'counter', 'Reused connections found dead and replaced.')
+describe('bss_db_reads_total', 'counter', 'acs4db queries, by query and where they ran (primary or replica).')
+describe('bss_db_replica_up', 'gauge', 'Whether a read replica is replicating, at its last check.')
+describe('bss_db_replica_lag_seconds', 'gauge', 'Replication lag of a read replica, at its last check.')
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+Maintains the local full-text index behind bss's /search/ endpoint: an
+sqlite FTS5 table over resourceitem identifier, title, creator and
+format.
+
+python bsssearch.py /var/lib/bss/search.db --once       # build it
+python bsssearch.py /var/lib/bss/search.db              # keep it fresh
+BSS_SEARCH_INDEX=/var/lib/bss/search.db                 # for bss.py
+
+resourceitem has no modification time to follow, so each pass walks
+the searchable columns in keyset pages (a replica will do, see
+README_bss) and compares a digest of each row with the one indexed;
+only new, changed and removed resources touch the index.
+
+"""
+from __future__ import print_function
+
+import hashlib
+import optparse
+import sqlite3
+import sys
+import time
+
+import bss
+
+# resourceitem columns indexed, besides resourceid
+indexed_fields = ('identifier', 'title', 'creator', 'format')
+
+page_size = 5000
+
+create_sql = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS resource_fts USING fts5(
+        resourceid UNINDEXED, identifier, title, creator, format,
+        prefix = '2 3', tokenize = 'unicode61 remove_diacritics 2')
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS resource_digest (
+        resourceid TEXT NOT NULL PRIMARY KEY,
+        digest TEXT NOT NULL,
+        ftsrowid INTEGER NOT NULL,
+        pass INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS search_state (
+        name TEXT NOT NULL PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """,
+]
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=60)
+    # bss keeps searching while a pass writes
+    conn.execute('PRAGMA journal_mode=WAL')
+    for sql in create_sql:
+        conn.execute(sql)
+    conn.commit()
+    return conn
+
+
+def digest(r):
+    h = hashlib.sha1()
+    for f in indexed_fields:
+        h.update((r.get(f) or '').encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def refresh(db, conn):
+    """ One pass over resourceitem; returns (added, changed, removed) """
+    c = conn.cursor()
+    c.execute("SELECT COALESCE(MAX(pass), 0) + 1 FROM resource_digest")
+    this_pass = c.fetchone()[0]
+    added = changed = 0
+    cursor = None
+    while True:
+        page = db.get_resource_info_page(page_size, cursor, ('resourceid', ) + indexed_fields)
+        for r in page['resources']:
+            d = digest(r)
+            c.execute("SELECT digest, ftsrowid FROM resource_digest WHERE resourceid = ?",
+                      (r['resourceid'], ))
+            row = c.fetchone()
+            if row is not None and row[0] == d:
+                c.execute("UPDATE resource_digest SET pass = ? WHERE resourceid = ?",
+                          (this_pass, r['resourceid']))
+                continue
+            if row is None:
+                added += 1
+            else:
+                changed += 1
+                c.execute("DELETE FROM resource_fts WHERE rowid = ?", (row[1], ))
+            c.execute("INSERT INTO resource_fts (resourceid, identifier, title, creator, format)"
+                      " VALUES (?, ?, ?, ?, ?)",
+                      (r['resourceid'], ) + tuple(r.get(f) for f in indexed_fields))
+            c.execute("REPLACE INTO resource_digest (resourceid, digest, ftsrowid, pass) VALUES (?, ?, ?, ?)",
+                      (r['resourceid'], d, c.lastrowid, this_pass))
+        cursor = page['next']
+        if cursor is None:
+            break
+
+    # anything not seen this pass is gone from resourceitem
+    c.execute("SELECT resourceid, ftsrowid FROM resource_digest WHERE pass < ?", (this_pass, ))
+    gone = c.fetchall()
+    for resourceid, ftsrowid in gone:
+        c.execute("DELETE FROM resource_fts WHERE rowid = ?", (ftsrowid, ))
+        c.execute("DELETE FROM resource_digest WHERE resourceid = ?", (resourceid, ))
+    c.execute("REPLACE INTO search_state (name, value) VALUES ('refreshed', ?)",
+              (time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), ))
+    conn.commit()
+    if added or changed or gone:
+        c.execute("INSERT INTO resource_fts (resource_fts) VALUES ('optimize')")
+        conn.commit()
+    return added, changed, len(gone)
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='usage: %prog [options] INDEX_FILE',
+                                   description='Keep the bss search index up to date.')
+    parser.add_option('--once',
+                      action='store_true',
+                      help='Run a single refresh pass and exit')
+    parser.add_option('--interval',
+                      action='store',
+                      type='float',
+                      default=300,
+                      help='Seconds between refresh passes (default 300)')
+    parser.add_option('--rebuild',
+                      action='store_true',
+                      help='Empty the index before the first pass')
+    parser.add_option('-d', '--debug',
+                      action='store_true',
+                      help='Print what each pass changed')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('Please supply the index file')
+
+    conn = connect(args[0])
+    if opts.rebuild:
+        conn.execute("DELETE FROM resource_fts")
+        conn.execute("DELETE FROM resource_digest")
+        conn.commit()
+
+    db = bss.acs4db()
+    while True:
+        start = time.time()
+        added, changed, removed = refresh(db, conn)
+        # a fresh connection each pass, so it can't read an old snapshot
+        db.close()
+        if opts.debug:
+            print('%d added, %d changed, %d removed in %.1fs'
+                  % (added, changed, removed, time.time() - start))
+        if opts.once:
+            break
+        time.sleep(opts.interval)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
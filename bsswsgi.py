@@ -0,0 +1,39 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+WSGI entry point for bss.py, for running it under a long-lived
+prefork and/or threaded server instead of as a CGI.  Each worker
+imports MySQLdb and web once, and each worker thread keeps its own
+database connection between requests.
+
+gunicorn -c bssgunicorn.py bsswsgi:application
+
+For mod_wsgi, point WSGIScriptAlias at this file.
+
+"""
+import web
+
+# Must be set before bss builds its web.application, or web.py runs in
+# development mode and checks every module for changes on each request.
+web.config.debug = False
+
+import bss  # noqa: E402
+
+
+application = bss.app.wsgifunc()
+
+
+def init_worker():
+    """
+    Connect to the database as a worker starts, so a bad deploy fails
+    at boot rather than on the first request.  Threads other than the
+    calling one connect on their first request.
+    """
+    bss.acs4db().connect()
+
+
+def close_worker():
+    """ Close this thread's database connections, e.g. on worker exit """
+    bss.default_backend.close()
+    for replica in bss.replicas:
+        replica.close()
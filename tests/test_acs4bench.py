@@ -0,0 +1,90 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+acs4bench.py: a run recorded against a stand-in ACS4 server replays
+with the same seed and no server.
+"""
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import acs4  # noqa: E402
+import acs4bench  # noqa: E402
+
+try:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class fake_acs4(BaseHTTPRequestHandler):
+    """ Answers any request with an empty response """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        reply = ('<response xmlns="%s"/>' % acs4.AdeptNS).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class record_replay_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cassette = os.path.join(self.dir, 'bench.cassette')
+        self.resources = os.path.join(self.dir, 'resources.txt')
+        with open(self.resources, 'w') as f:
+            for i in range(20):
+                f.write('urn:uuid:00000000-0000-0000-0000-%012d\tbook%d\n' % (i, i))
+
+    def tearDown(self):
+        acs4.cassette = None
+        shutil.rmtree(self.dir)
+
+    def bench(self, port, *args):
+        argv = ['--rps=40', '--duration=0.5', '--mix=request_get:3,query:1', '--seed=7',
+                '--server=127.0.0.1', '--port=%d' % port, '--password=pw',
+                '--distributor=urn:uuid:dist', '--resources=' + self.resources] + list(args)
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            acs4bench.main(argv)
+            return json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+
+    def test_record_replay(self):
+        httpd = HTTPServer(('127.0.0.1', 0), fake_acs4)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        port = httpd.server_address[1]
+        try:
+            recorded = self.bench(port, '--record=' + self.cassette)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        self.assertEqual(recorded['requests'], 20)
+        self.assertEqual(recorded['errors'], 0)
+
+        replayed = self.bench(port, '--replay=' + self.cassette, '--latency_scale=0')
+        self.assertEqual(replayed['requests'], 20)
+        self.assertEqual(replayed['errors'], 0, replayed.get('error_samples'))
+        for op in ('request_get', 'query'):
+            self.assertEqual(replayed['operations'][op]['requests'],
+                             recorded['operations'][op]['requests'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+acs4mint.py: loading distributor secrets, recorded from a stand-in
+ACS4 server and replayed from the cassette without it.
+"""
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import acs4  # noqa: E402
+import acs4cassette  # noqa: E402
+import acs4mint  # noqa: E402
+
+try:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+distributor = 'urn:uuid:00000000-0000-0000-0000-000000000002'
+secret = base64.b64encode(b'0123456789abcdefghij').decode('ascii')
+
+distributor_reply = ('<response xmlns="%s"><distributorData>'
+                     '<distributor>%s</distributor><name>Test Library</name>'
+                     '<sharedSecret>%s</sharedSecret>'
+                     '</distributorData></response>' % (acs4.AdeptNS, distributor, secret))
+
+
+class fake_acs4(BaseHTTPRequestHandler):
+    """ Answers every Distributor request, checking it's signed """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        el = acs4.etree.fromstring(body)
+        hmac_el = el.find(acs4.AdeptNSBracketed + 'hmac')
+        el.remove(hmac_el)
+        if hmac_el.text != acs4.make_hmac('password', el):
+            reply = '<error xmlns="%s" data="E_ADEPT_BAD_HMAC"/>' % acs4.AdeptNS
+        else:
+            reply = distributor_reply
+        reply = reply.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class refresh_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'acs4.cassette')
+
+    def tearDown(self):
+        acs4.cassette = None
+        shutil.rmtree(self.dir)
+
+    def record(self):
+        httpd = HTTPServer(('127.0.0.1', 0), fake_acs4)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        try:
+            acs4.cassette = acs4cassette.cassette(self.path, 'record')
+            dists = acs4mint.distributors('127.0.0.1', 'password', [distributor],
+                                          port=httpd.server_address[1])
+            dists.refresh()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        return dists, httpd.server_address[1]
+
+    def test_refresh(self):
+        dists, port = self.record()
+        self.assertEqual(dists.refresh_errors, 0)
+        self.assertEqual(dists.get(distributor), (secret, 'Test Library'))
+
+        # the server is gone; the secrets come from the cassette
+        acs4.cassette = acs4cassette.cassette(self.path, 'replay', latency_scale=0)
+        dists = acs4mint.distributors('127.0.0.1', 'password', [distributor], port=port)
+        dists.refresh()
+        self.assertEqual(dists.refresh_errors, 0)
+        self.assertEqual(dists.get(distributor), (secret, 'Test Library'))
+        self.assertTrue(dists.refreshed)
+
+        m = acs4mint.minter(dists, 60, 'acs4.example.org', default_distributor=distributor)
+        self.assertTrue(m.mint({'resource': 'urn:uuid:res'}).startswith(
+            'http://acs4.example.org:8080/fulfillment/URLLink.acsm?'))
+
+    def test_refresh_keeps_old_secret(self):
+        dists, port = self.record()
+        # nothing recorded for another distributor, so that refresh fails
+        acs4.cassette = acs4cassette.cassette(self.path, 'replay', latency_scale=0)
+        dists.ids.append('urn:uuid:00000000-0000-0000-0000-000000000003')
+        dists.refresh()
+        self.assertEqual(dists.refresh_errors, 1)
+        self.assertEqual(dists.get(distributor), (secret, 'Test Library'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+acs4notify.py: signed notifications posted to a running receiver.
+"""
+import base64
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import acs4  # noqa: E402
+import acs4notify  # noqa: E402
+
+try:  # Python 3
+    from http.client import HTTPConnection
+except ImportError:  # Python 2
+    from httplib import HTTPConnection
+
+secret = base64.b64encode(b'0123456789abcdefghij').decode('ascii')
+
+
+def notification(transaction='urn:uuid:trans-1', sign_with=secret, hmac_text=None):
+    el = acs4.etree.Element('notification', nsmap={None: acs4.AdeptNS})
+    for name, value in (('transaction', transaction),
+                        ('distributor', 'urn:uuid:dist'),
+                        ('resource', 'urn:uuid:res'),
+                        ('returned', 'false')):
+        acs4.etree.SubElement(el, name).text = value
+    if hmac_text is None and sign_with is not None:
+        hmac_text = acs4.make_hmac(sign_with, el)
+    if hmac_text is not None:
+        acs4.etree.SubElement(el, 'hmac').text = hmac_text
+    return acs4.etree.tostring(el)
+
+
+class signed_notification_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        store = acs4notify.store(os.path.join(self.dir, 'notify.db'))
+        store.start()
+        self.handler = type('test_handler', (acs4notify.handler, ), {'store': store, 'secret': secret})
+        self.httpd = acs4notify.threaded_server(('127.0.0.1', 0), self.handler)
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.dir)
+
+    def post(self, body):
+        conn = HTTPConnection('127.0.0.1', self.httpd.server_address[1], timeout=10)
+        conn.request('POST', '/notify', body, {'Content-Type': 'application/vnd.adobe.adept+xml'})
+        response = conn.getresponse()
+        result = response.status, json.loads(response.read().decode('utf-8'))
+        conn.close()
+        return result
+
+    def test_make_hmac_is_text(self):
+        el = acs4.etree.Element('notification', nsmap={None: acs4.AdeptNS})
+        self.assertIsInstance(acs4.make_hmac(secret, el), type(u''))
+
+    def test_signed(self):
+        self.assertEqual(self.post(notification()), (200, {'stored': True}))
+        self.assertEqual(self.post(notification()), (200, {'stored': False}))
+
+    def test_wrong_secret(self):
+        other = base64.b64encode(b'jihgfedcba9876543210').decode('ascii')
+        status, body = self.post(notification(sign_with=other))
+        self.assertEqual(status, 403)
+
+    def test_tampered(self):
+        body = notification().replace(b'urn:uuid:res', b'urn:uuid:other')
+        self.assertEqual(self.post(body)[0], 403)
+
+    def test_unsigned(self):
+        self.assertEqual(self.post(notification(sign_with=None))[0], 403)
+
+    def test_non_ascii_hmac(self):
+        self.assertEqual(self.post(notification(hmac_text=u'été'))[0], 403)
+
+
+if __name__ == '__main__':
+    unittest.main()
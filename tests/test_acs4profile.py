@@ -0,0 +1,77 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+acs4profile.py: profiled calls from several threads at once.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import acs4profile  # noqa: E402
+
+
+class profiler_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.profiler = acs4profile.profiler(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_overlapping_calls(self):
+        gate = threading.Barrier(4) if hasattr(threading, 'Barrier') else None
+        results = {}
+        errors = []
+
+        def total(n):
+            return sum(i * n for i in range(200000))
+
+        def work(n):
+            # hold every thread here so their profiled calls overlap
+            if gate is not None:
+                gate.wait()
+            return total(n)
+
+        def call(n):
+            try:
+                results[n] = self.profiler.run('test', work, n)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call, args=(n, )) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, dict((n, total(n)) for n in range(4)))
+        self.assertTrue([f for f in os.listdir(self.dir) if f.endswith('.prof')])
+
+    def test_write_failure_keeps_result(self):
+        def broken_write(*args):
+            raise IOError('disk full')
+        self.profiler.write = broken_write
+        self.assertEqual(self.profiler.run('test', lambda: 42), 42)
+
+    def test_exception_passes_through(self):
+        def fail():
+            raise KeyError('x')
+        self.assertRaises(KeyError, self.profiler.run, 'test', fail)
+
+    def test_default_rate(self):
+        os.environ['TESTPROF_DIR'] = self.dir
+        try:
+            self.assertEqual(acs4profile.from_env('TESTPROF').rate, acs4profile.default_rate)
+        finally:
+            del os.environ['TESTPROF_DIR']
+        self.assertTrue(acs4profile.default_rate < 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+acs4rights.py: planning creates and updates from desired and current
+distribution rights.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import acs4rights  # noqa: E402
+
+key = ('urn:uuid:dist', 'urn:uuid:res')
+
+current_record = {
+    'distributor': 'urn:uuid:dist',
+    'resource': 'urn:uuid:res',
+    'distributionType': 'loan',
+    'available': '3',
+    'returnable': 'true',
+    'userType': 'user',
+    'notifyURL': 'http://example.org/notify',
+    'permissions': {'display': {'device': None}},
+    'used': '1',
+}
+
+
+class plan_test(unittest.TestCase):
+
+    def test_update_keeps_whole_record(self):
+        want = {'distributor': 'urn:uuid:dist', 'resource': 'urn:uuid:res', 'available': 5}
+        creates, updates, unchanged, unmanaged = acs4rights.plan({key: want}, {key: dict(current_record)})
+        self.assertEqual((creates, unchanged, unmanaged), ([], [], []))
+        [(record, changes)] = updates
+        self.assertEqual(changes, {'available': ('3', '5')})
+        expected = acs4rights.request_args(dict(current_record, available=5))
+        self.assertEqual(record, expected)
+        # fields plan doesn't compare are carried over too
+        self.assertEqual(record['used'], '1')
+
+    def test_only_changed_fields_replaced(self):
+        # returnable differs only in spelling, so the current value is sent
+        want = {'distributor': 'urn:uuid:dist', 'resource': 'urn:uuid:res',
+                'returnable': 'TRUE', 'userType': 'anon'}
+        [(record, changes)] = acs4rights.plan({key: want}, {key: dict(current_record)})[1]
+        self.assertEqual(set(changes), set(['userType']))
+        self.assertEqual(record['returnable'], 'true')
+        self.assertEqual(record['userType'], 'anon')
+
+    def test_unchanged_and_unmanaged(self):
+        other = ('urn:uuid:dist', 'urn:uuid:other')
+        want = {'distributor': 'urn:uuid:dist', 'resource': 'urn:uuid:res', 'available': '3'}
+        current = {key: dict(current_record), other: dict(current_record, resource='urn:uuid:other')}
+        self.assertEqual(acs4rights.plan({key: want}, current), ([], [], [key], [other]))
+
+    def test_create(self):
+        want = {'distributor': 'urn:uuid:dist', 'resource': 'urn:uuid:res', 'available': 0}
+        [(record, changes)] = acs4rights.plan({key: want}, {})[0]
+        self.assertEqual(record['available'], '0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+bss.py: read replica lag checks, gzip by Accept-Encoding, and the
+loan-state freshness check.
+"""
+import datetime
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bss  # noqa: E402
+import bssfake  # noqa: E402
+
+
+def fake_db(path):
+    """ A small bssfake.py database at path """
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            bssfake.main([path, '--resources=20', '--loans=50'])
+        finally:
+            sys.stdout = stdout
+
+
+class probed_backend(bss.sqlite_backend):
+    """ An sqlite replica that records its connects, and can be taken down """
+
+    def __init__(self, path):
+        bss.sqlite_backend.__init__(self, path)
+        self.down = False
+        self.connects = []
+
+    def connect(self, timeout=None):
+        self.connects.append(timeout)
+        if self.down:
+            raise sqlite3.OperationalError('unable to open database file')
+        return bss.sqlite_backend.connect(self, timeout=timeout)
+
+
+class replica_lag_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.replica = probed_backend(os.path.join(self.dir, 'replica.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_probe_is_short_and_separate(self):
+        self.assertEqual(bss._replica_lag(self.replica), 0)
+        self.assertEqual(self.replica.connects, [bss.replica_connect_timeout])
+        # request connections are the thread's own, not the probe's
+        self.assertIsNone(getattr(self.replica.local, 'conn', None))
+
+    def test_down_replica_fails_once(self):
+        self.replica.down = True
+        self.assertIsNone(bss._replica_lag(self.replica))
+        self.assertEqual(len(self.replica.connects), 1)
+        # not rechecked until replica_check_interval has passed
+        self.assertIsNone(bss._replica_lag(self.replica))
+        self.assertEqual(len(self.replica.connects), 1)
+
+    def test_recovers(self):
+        self.replica.down = True
+        self.assertIsNone(bss._replica_lag(self.replica))
+        self.replica.down = False
+        self.replica.lag_checked = 0
+        self.assertEqual(bss._replica_lag(self.replica), 0)
+
+    def test_check_in_progress_uses_last_value(self):
+        self.replica.lag = 3
+        self.replica.lag_lock.acquire()
+        try:
+            self.assertEqual(bss._replica_lag(self.replica), 3)
+        finally:
+            self.replica.lag_lock.release()
+        self.assertEqual(self.replica.connects, [])
+
+
+class accept_encoding_test(unittest.TestCase):
+
+    def test_accepts_gzip(self):
+        for header, expected in (('gzip', True),
+                                 ('gzip, deflate, br', True),
+                                 ('GZIP;q=0.5', True),
+                                 ('x-gzip', True),
+                                 ('*', True),
+                                 ('gzip;q=0', False),
+                                 ('gzip; q=0.0, deflate', False),
+                                 ('*;q=0', False),
+                                 ('gzip;q=0, *', False),
+                                 ('*;q=0, gzip', True),
+                                 ('identity', False),
+                                 ('nogzip', False),
+                                 ('', False)):
+            self.assertEqual(bss._accepts_gzip(header), expected, header)
+
+
+class gzip_response_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'adept.db')
+        fake_db(path)
+        self.backend, bss.default_backend = bss.default_backend, bss.sqlite_backend(path)
+
+    def tearDown(self):
+        bss.default_backend.close()
+        bss.default_backend = self.backend
+        shutil.rmtree(self.dir)
+
+    def get(self, accept_encoding):
+        return bss.app.request('/resource_info/', headers={'Accept-Encoding': accept_encoding})
+
+    def test_gzip(self):
+        response = self.get('deflate, gzip')
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertTrue(response.headers['ETag'].endswith('-gzip"'))
+
+    def test_gzip_refused(self):
+        for header in ('gzip;q=0', 'identity, *;q=0', 'nogzip'):
+            response = self.get(header)
+            self.assertNotIn('Content-Encoding', response.headers, header)
+            self.assertFalse(response.headers['ETag'].endswith('-gzip"'), header)
+
+
+class shifted_backend(bss.sqlite_backend):
+    """ A database whose NOW() is hours off this host's UTC clock, like a MySQL session timezone """
+
+    shift = datetime.timedelta(hours=-5)
+
+    def now(self):
+        return (datetime.datetime.utcnow() + self.shift).strftime('%Y-%m-%d %H:%M:%S')
+
+    def connect(self, timeout=None):
+        conn = bss.sqlite_backend.connect(self, timeout=timeout)
+        conn.create_function('NOW', 0, self.now)
+        return conn
+
+
+class loan_state_fresh_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'adept.db')
+        fake_db(path)
+        self.db = bss.acs4db(shifted_backend(path))
+        self.db.connect()
+
+    def tearDown(self):
+        self.db.backend.close()
+        shutil.rmtree(self.dir)
+
+    def refreshed(self, seconds_ago):
+        c = self.db.conn.cursor()
+        self.db.backend.execute(c, "UPDATE bss_watermark SET refreshed = %s WHERE name = 'loanstate'",
+                                (self.db.backend.now()[:19], ))
+        if seconds_ago:
+            c.execute("UPDATE bss_watermark SET refreshed = datetime(refreshed, ?) WHERE name = 'loanstate'",
+                      ('-%d seconds' % seconds_ago, ))
+        self.db.conn.commit()
+
+    def test_fresh_by_database_clock(self):
+        self.refreshed(0)
+        self.assertTrue(self.db._loan_state_fresh())
+
+    def test_stale(self):
+        self.refreshed(bss.loan_state_max_age + 10)
+        self.assertFalse(self.db._loan_state_fresh())
+
+    def test_never_refreshed(self):
+        c = self.db.conn.cursor()
+        c.execute("DELETE FROM bss_watermark WHERE name = 'loanstate'")
+        self.db.conn.commit()
+        self.assertFalse(self.db._loan_state_fresh())
+
+
+if __name__ == '__main__':
+    unittest.main()
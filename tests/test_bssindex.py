@@ -0,0 +1,47 @@
+"""
+Copyright(c)2010 Internet Archive. Software license AGPL version 3.
+
+bssindex.py: the queries it EXPLAINs are the ones bss.py runs.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bss  # noqa: E402
+import bssindex  # noqa: E402
+
+from test_bss import fake_db  # noqa: E402
+
+
+class bss_queries_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'adept.db')
+        fake_db(path)
+        self.backend = bss.sqlite_backend(path)
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.dir)
+
+    def test_every_acs4db_query(self):
+        sql = [q[1] for q in bssindex.bss_queries()]
+        for name in ('fulfillment_sql', 'loaned_out_sql', 'active_loan_sql', 'availability_sql',
+                     'loan_event_sql', 'loan_state_sql', 'history_sql', 'resource_sql',
+                     'resource_by_id_sql', 'transaction_sql'):
+            prefix = getattr(bss.acs4db, name).split('%s')[0]
+            self.assertTrue(any(s.startswith(prefix) for s in sql), name)
+
+    def test_queries_run(self):
+        c = self.backend.connection().cursor()
+        for name, sql, args in bssindex.bss_queries():
+            self.backend.execute(c, 'EXPLAIN ' + sql, args)
+
+
+if __name__ == '__main__':
+    unittest.main()